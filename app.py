@@ -2,19 +2,31 @@ import os
 import subprocess
 import uuid
 import json
+import time
 import base64
+import hashlib
 import threading
-import traceback
+import multiprocessing
+from collections import OrderedDict
 from io import BytesIO
 from datetime import datetime
 
 from dotenv import load_dotenv
-from flask import Flask, render_template, request, jsonify, Response
-from PIL import Image, PngImagePlugin
-
-from metadata_parser import extract_metadata
-from prompt_editor import apply_edits
+from flask import Flask, render_template, request, jsonify, Response, stream_with_context, send_file, abort
+from PIL import Image
+from werkzeug.http import parse_options_header
+from werkzeug.security import safe_join
+from werkzeug.sansio.multipart import MultipartDecoder, NEED_DATA, File, Field, Data, Epilogue
+
+from metadata_parser import extract_metadata, metadata_from_text, PngChunkReader
+from prompt_editor import apply_edits, diff_prompts, matched_removals, removal_cores
 from forge_client import ForgeClient
+from generation import compile_rules, rule_hits
+from storage import open_storage
+import sweep
+import draft
+import worker
+import previews
 
 load_dotenv()
 
@@ -23,9 +35,26 @@ app = Flask(__name__)
 APP_PORT = int(os.getenv('APP_PORT', '4644'))
 OUTPUT_DIR = os.getenv('OUTPUT_DIR', './output')
 
-# In-memory storage for uploaded images and generation sessions
-uploaded_images = {}  # id -> { filename, filepath, metadata }
-generation_sessions = {}  # session_id -> { events: [], done: bool }
+UPLOAD_CHUNK_SIZE = 64 * 1024
+PREVIEW_PAGE_SIZE = 50
+PREVIEW_MAX_PAGE_SIZE = 500
+PREVIEW_CACHE_SIZE = 16
+PROGRESS_POLL_INTERVAL = 0.3
+RESULTS_PAGE_SIZE = 60
+RESULTS_MAX_PAGE_SIZE = 500
+# Outputs can be rewritten under the same name (e.g. two inputs with the same
+# filename in one run), so browsers revalidate every time via ETag/Last-Modified
+OUTPUT_MAX_AGE = None  # Cache-Control: no-cache
+
+# Uploaded images and generation sessions/events live in shared storage so
+# that any web worker can serve any request
+storage = open_storage()
+
+# Per-process cache: (edit spec, image ids) -> computed preview { items, summary }, LRU-bounded
+preview_cache = OrderedDict()
+preview_cache_lock = threading.Lock()
+
+_EDIT_KEYS = ('remove_positive', 'remove_negative', 'add_positive', 'add_negative')
 
 
 @app.route('/')
@@ -68,18 +97,13 @@ def upload():
         os.remove(filepath)
         return jsonify({'error': 'SDメタデータが見つかりません (Forge/A1111形式のPNGのみ対応)'}), 400
 
-    # Generate thumbnail (data URL)
-    with Image.open(filepath) as img:
-        img.thumbnail((200, 200))
-        buf = BytesIO()
-        img.save(buf, format='PNG')
-        thumbnail = 'data:image/png;base64,' + base64.b64encode(buf.getvalue()).decode()
+    thumbnail = _make_thumbnail(filepath)
 
-    uploaded_images[img_id] = {
+    storage.put_image(img_id, {
         'filename': file.filename,
         'filepath': filepath,
         'metadata': metadata,
-    }
+    })
 
     return jsonify({
         'id': img_id,
@@ -89,6 +113,272 @@ def upload():
     })
 
 
+@app.route('/api/upload/batch', methods=['POST'])
+def upload_batch():
+    """Upload many PNG files in one multipart request.
+
+    Each file part is hashed and run through the PNG chunk reader while it
+    is received, so files without SD metadata are rejected before anything
+    is written to disk. Results are streamed back as NDJSON, one line per file.
+    """
+    mimetype, options = parse_options_header(request.headers.get('Content-Type', ''))
+    boundary = options.get('boundary')
+    if mimetype != 'multipart/form-data' or not boundary:
+        return jsonify({'error': 'multipart/form-data で送信してください'}), 400
+
+    stream = request.stream
+
+    def results():
+        decoder = MultipartDecoder(boundary.encode('latin-1'))
+        current = None
+        try:
+            while True:
+                event = decoder.next_event()
+                if event is NEED_DATA:
+                    chunk = stream.read(UPLOAD_CHUNK_SIZE)
+                    decoder.receive_data(chunk or None)
+                elif isinstance(event, File):
+                    current = _StreamedUpload(event.filename)
+                elif isinstance(event, Field):
+                    current = None
+                elif isinstance(event, Data) and current is not None:
+                    current.write(event.data)
+                    if not event.more_data:
+                        yield json.dumps(current.finish(), ensure_ascii=False) + '\n'
+                        current = None
+                elif isinstance(event, Epilogue):
+                    break
+        except ValueError:
+            # Truncated or malformed body (e.g. client aborted mid-upload)
+            if current is not None:
+                current.abort()
+                yield json.dumps({
+                    'filename': current.filename,
+                    'error': 'アップロードが中断されました',
+                }, ensure_ascii=False) + '\n'
+
+    return Response(stream_with_context(results()), mimetype='application/x-ndjson')
+
+
+class _StreamedUpload:
+    """A single file part of a batch upload, parsed and hashed as it arrives.
+
+    Bytes before the first IDAT chunk are held in memory until the metadata
+    is known; only files with SD metadata are spooled to disk.
+    """
+
+    def __init__(self, filename: str):
+        self.filename = filename
+        self.img_id = str(uuid.uuid4())
+        self.temp_dir = os.path.join(OUTPUT_DIR, '.tmp')
+        self.filepath = os.path.join(self.temp_dir, f'{self.img_id}.png')
+        self.reader = PngChunkReader()
+        self.hasher = hashlib.sha256()
+        self.metadata = None
+        self.error = None
+        self._pending = []
+        self._fp = None
+        self._reused = False
+        if not filename.lower().endswith('.png'):
+            self.error = 'PNGファイルのみ対応しています'
+
+    def write(self, data: bytes) -> None:
+        if self.error or not data:
+            return
+        self.hasher.update(data)
+
+        if not self.reader.done:
+            self.reader.feed(data)
+            if self.reader.error:
+                self._reject(self.reader.error)
+                return
+            if not self.reader.done:
+                self._pending.append(data)
+                return
+            self.metadata = metadata_from_text(self.reader.parameters)
+            if self.metadata is None:
+                self._reject('SDメタデータが見つかりません (Forge/A1111形式のPNGのみ対応)')
+                return
+            os.makedirs(self.temp_dir, exist_ok=True)
+            self._fp = open(self.filepath, 'wb')
+            self._pending.append(data)
+            for pending in self._pending:
+                self._fp.write(pending)
+            self._pending = []
+            return
+
+        self._fp.write(data)
+
+    def finish(self) -> dict:
+        """Close the part and return its result line."""
+        if self.error is None and self._fp is None:
+            # Stream ended before any image data
+            self._reject('PNGファイルが不完全です')
+        if self.error:
+            return {'filename': self.filename, 'error': self.error}
+        self._fp.close()
+
+        digest = self.hasher.hexdigest()
+        existing = storage.find_image_by_hash(digest)
+        if existing and os.path.exists(existing[1]['filepath']):
+            # Identical file already uploaded: reuse it instead of keeping a copy
+            os.remove(self.filepath)
+            self.img_id, record = existing
+            self.filepath = record['filepath']
+            self._reused = True
+
+        try:
+            thumbnail = _make_thumbnail(self.filepath)
+        except Exception:
+            self.abort()
+            return {'filename': self.filename, 'error': 'PNGファイルを読み込めませんでした'}
+
+        # A reused record keeps its original filename: the client keeps the
+        # first upload's entry for that id, and previews read the stored name
+        if not self._reused:
+            storage.put_image(self.img_id, {
+                'filename': self.filename,
+                'filepath': self.filepath,
+                'metadata': self.metadata,
+                'sha256': digest,
+            })
+
+        return {
+            'id': self.img_id,
+            'filename': self.filename,
+            'thumbnail': thumbnail,
+            'metadata': self.metadata,
+        }
+
+    def abort(self) -> None:
+        """Discard any partially written file."""
+        if self._fp is not None:
+            self._fp.close()
+            self._fp = None
+            if os.path.exists(self.filepath) and not self._reused:
+                os.remove(self.filepath)
+        self._pending = []
+
+    def _reject(self, message: str) -> None:
+        self.error = message
+        self.abort()
+
+
+def _make_thumbnail(filepath: str) -> str:
+    """Generate a 200px PNG thumbnail as a data URL."""
+    with Image.open(filepath) as img:
+        img.thumbnail((200, 200))
+        buf = BytesIO()
+        img.save(buf, format='PNG')
+        return 'data:image/png;base64,' + base64.b64encode(buf.getvalue()).decode()
+
+
+@app.route('/api/preview', methods=['POST'])
+def preview():
+    """Apply edits to uploaded images and return a page of token-level diffs.
+
+    Request JSON: { image_ids: [...], edits: {...}, page: 1, per_page: 50 }
+    Edits are applied with prompt_editor, and the full result for an
+    (edit spec, image set) pair is cached so paging does not recompute.
+    """
+    data = request.get_json()
+    if not data or 'image_ids' not in data:
+        return jsonify({'error': 'リクエストデータが不正です'}), 400
+
+    image_ids = data['image_ids']
+    edits = data.get('edits') or {}
+    if not isinstance(image_ids, list) or not all(isinstance(i, str) for i in image_ids):
+        return jsonify({'error': 'image_ids は文字列の配列で指定してください'}), 400
+    if not isinstance(edits, dict) or not all(isinstance(edits.get(k) or '', str) for k in _EDIT_KEYS):
+        return jsonify({'error': '編集内容は文字列で指定してください'}), 400
+    try:
+        page = max(1, int(data.get('page', 1)))
+        per_page = min(max(1, int(data.get('per_page', PREVIEW_PAGE_SIZE))), PREVIEW_MAX_PAGE_SIZE)
+    except (ValueError, TypeError):
+        return jsonify({'error': 'ページ指定が不正です'}), 400
+
+    records = storage.get_images(image_ids)
+    missing = [img_id for img_id in image_ids if img_id not in records]
+    if missing:
+        return jsonify({
+            'error': '画像が見つかりません。再度読み込んでください',
+            'missing': missing,
+        }), 404
+
+    edit_spec = {k: edits.get(k, '') or '' for k in _EDIT_KEYS}
+    for side in ('positive', 'negative'):
+        edit_spec[f'rules_{side}'] = edits.get(f'rules_{side}') or []
+    cache_key = (json.dumps(edit_spec, sort_keys=True), tuple(image_ids))
+    with preview_cache_lock:
+        result = preview_cache.get(cache_key)
+        if result is not None:
+            preview_cache.move_to_end(cache_key)
+    if result is None:
+        try:
+            rule_sets = compile_rules(edit_spec)
+        except ValueError as e:
+            return jsonify({'error': f'ルールが不正です: {e}'}), 400
+        result = _compute_preview(image_ids, records, edit_spec, rule_sets)
+        with preview_cache_lock:
+            preview_cache[cache_key] = result
+            while len(preview_cache) > PREVIEW_CACHE_SIZE:
+                preview_cache.popitem(last=False)
+
+    total = len(result['items'])
+    start = (page - 1) * per_page
+    return jsonify({
+        'page': page,
+        'per_page': per_page,
+        'total': total,
+        'pages': max(1, -(-total // per_page)),
+        'summary': result['summary'],
+        'items': result['items'][start:start + per_page],
+    })
+
+
+def _compute_preview(image_ids, records, edits, rule_sets):
+    """Apply edits to every image and collect per-image diffs and summary counts."""
+    remove_pos_hits = {core: 0 for core in removal_cores(edits['remove_positive'])}
+    remove_neg_hits = {core: 0 for core in removal_cores(edits['remove_negative'])}
+    items = []
+    changed = 0
+
+    for img_id in image_ids:
+        entry = records[img_id]
+        metadata = entry['metadata']
+        item = {'id': img_id, 'filename': entry['filename']}
+        image_changed = False
+
+        for side, hits in (('positive', remove_pos_hits), ('negative', remove_neg_hits)):
+            before = metadata.get(f'{side}_prompt', '')
+            rewritten = rule_sets[side].apply(before) if rule_sets[side] is not None else before
+            for core in matched_removals(rewritten, edits[f'remove_{side}']):
+                hits[core] += 1
+            after = apply_edits(rewritten, edits[f'remove_{side}'], edits[f'add_{side}'])
+            diff = diff_prompts(before, after)
+            removed = sum(len(span['tokens']) for span in diff if span['op'] == 'removed')
+            added = sum(len(span['tokens']) for span in diff if span['op'] == 'added')
+            item[side] = {'text': after, 'diff': diff, 'removed': removed, 'added': added}
+            # Token-level comparison: separator/whitespace normalization alone is not a change
+            if removed or added:
+                image_changed = True
+
+        if image_changed:
+            changed += 1
+        items.append(item)
+
+    return {
+        'items': items,
+        'summary': {
+            'images': len(items),
+            'changed': changed,
+            'remove_positive': remove_pos_hits,
+            'remove_negative': remove_neg_hits,
+            'rule_hits': rule_hits(rule_sets),
+        },
+    }
+
+
 @app.route('/api/check-forge')
 def check_forge():
     """Check Forge API connection."""
@@ -114,200 +404,96 @@ def generate():
     if not images:
         return jsonify({'error': '画像がありません'}), 400
 
-    session_id = str(uuid.uuid4())
-    generation_sessions[session_id] = {
-        'events': [],
-        'done': False,
-    }
+    try:
+        compile_rules(edits)
+    except ValueError as e:
+        return jsonify({'error': f'ルールが不正です: {e}'}), 400
 
-    # Start generation in background thread
-    thread = threading.Thread(
-        target=_generation_worker,
-        args=(session_id, images, edits, host, port),
-        daemon=True,
-    )
-    thread.start()
+    sweep_axes = None
+    if data.get('sweep'):
+        try:
+            sweep_axes = sweep.validate_sweep(data['sweep'], len(images))
+        except ValueError as e:
+            return jsonify({'error': f'スイープ指定が不正です: {e}'}), 400
 
+    draft_mode = bool(data.get('draft'))
+    session_id = _start_generation(images, edits, sweep_axes, draft_mode, host, port)
     return jsonify({'session_id': session_id})
 
 
-def _generation_worker(session_id, images, edits, host, port):
-    """Background worker for batch image generation."""
-    session = generation_sessions[session_id]
-    client = ForgeClient(host, port)
-
-    # Prepare output directory path (created on first successful generation)
-    timestamp = datetime.now().strftime('%Y%m%d%H%M%S')
-    out_dir = os.path.join(OUTPUT_DIR, timestamp)
-    out_dir_created = False
-
-    # Group by model to minimize model switches
-    model_groups = {}
-    for img_data in images:
-        model_key = img_data['metadata'].get('Model', '') + '|' + img_data['metadata'].get('Model hash', '')
-        if model_key not in model_groups:
-            model_groups[model_key] = []
-        model_groups[model_key].append(img_data)
-
-    # Flatten back to ordered list (grouped by model)
-    ordered = []
-    for group in model_groups.values():
-        ordered.extend(group)
-
-    total = len(ordered)
-    success = 0
-    failed = 0
-    generated_files = []
-
-    for i, img_data in enumerate(ordered):
-        filename = img_data['filename']
-        metadata = dict(img_data['metadata'])
-
-        # Send progress event
-        _add_event(session, 'progress', {
-            'current': i + 1,
-            'total': total,
-            'filename': filename,
-        })
-
-        try:
-            # Apply edits to prompts
-            metadata['positive_prompt'] = apply_edits(
-                metadata.get('positive_prompt', ''),
-                edits.get('remove_positive', ''),
-                edits.get('add_positive', ''),
-            )
-            metadata['negative_prompt'] = apply_edits(
-                metadata.get('negative_prompt', ''),
-                edits.get('remove_negative', ''),
-                edits.get('add_negative', ''),
-            )
-
-            # Build payload and generate
-            payload = client.build_payload(metadata)
-            print(f"\n=== Payload for {filename} ===")
-            print(json.dumps({k: v for k, v in payload.items() if k != 'infotext'}, ensure_ascii=False, indent=2))
-            print(f"infotext:\n{payload.get('infotext', '(none)')}")
-            print("=" * 40)
-            result = client.txt2img(payload)
-
-            # Save image
-            if result.get('images'):
-                img_b64 = result['images'][0]
-                img_bytes = base64.b64decode(img_b64)
-
-                if not out_dir_created:
-                    os.makedirs(out_dir, exist_ok=True)
-                    out_dir_created = True
-                out_path = os.path.join(out_dir, filename)
-                _save_image_with_metadata(img_bytes, out_path, result.get('info'))
-
-                success += 1
-                generated_files.append(filename)
-                # Send payload info (without infotext raw text for brevity)
-                payload_info = {k: v for k, v in payload.items() if k not in ('infotext', 'send_images', 'save_images', 'override_settings_restore_afterwards')}
-                _add_event(session, 'image_done', {'filename': filename, 'payload': payload_info})
-            else:
-                failed += 1
-                _add_event(session, 'error_event', {
-                    'filename': filename,
-                    'message': '画像データが返却されませんでした',
-                })
-
-        except Exception as e:
-            failed += 1
-            tb = traceback.format_exc()
-            print(f"\n!!! Error for {filename} !!!")
-            print(tb)
-            _add_event(session, 'error_event', {
-                'filename': filename,
-                'message': str(e),
-            })
-            # Stop on first error
-            break
-
-    # Complete
-    _add_event(session, 'complete', {
-        'output_dir': os.path.abspath(out_dir),
-        'output_subdir': os.path.basename(out_dir),
-        'total': total,
-        'success': success,
-        'failed': failed,
-        'files': generated_files,
-    })
-    session['done'] = True
+@app.route('/api/generate/final', methods=['POST'])
+def generate_final():
+    """Re-render approved draft outputs at full quality with their seeds.
 
+    Request JSON: { output_subdir, files: [...], host, port } where files are
+    draft output paths as listed by /api/results.
+    """
+    data = request.get_json()
+    if not data or not data.get('output_subdir') or not data.get('files'):
+        return jsonify({'error': 'リクエストデータが不正です'}), 400
+    files = data['files']
+    if not isinstance(data['output_subdir'], str) or not isinstance(files, list) \
+            or not all(isinstance(f, str) for f in files):
+        return jsonify({'error': 'リクエストデータが不正です'}), 400
 
-def _save_image_with_metadata(img_bytes: bytes, out_path: str, info_json: str | None):
-    """Save image bytes as PNG, preserving or restoring metadata."""
-    img = Image.open(BytesIO(img_bytes))
-
-    # Check if image already has parameters metadata
-    existing_params = img.info.get('parameters')
-    if existing_params:
-        # Already has metadata, save as-is
-        png_info = PngImagePlugin.PngInfo()
-        png_info.add_text('parameters', existing_params)
-        img.save(out_path, pnginfo=png_info)
-        return
+    draft_dir = _output_path(data['output_subdir'])
+    if draft_dir is None or not os.path.isdir(draft_dir):
+        return jsonify({'error': 'ドラフトの出力が見つかりません'}), 404
 
-    # Try to restore from API response info
-    if info_json:
-        try:
-            if isinstance(info_json, str):
-                info = json.loads(info_json)
-            else:
-                info = info_json
-            infotxt = info.get('infotexts', [None])[0]
-            if infotxt:
-                png_info = PngImagePlugin.PngInfo()
-                png_info.add_text('parameters', infotxt)
-                img.save(out_path, pnginfo=png_info)
-                return
-        except (json.JSONDecodeError, KeyError, IndexError, TypeError):
-            pass
+    images = draft.load_approved(draft_dir, files)
+    if not images:
+        return jsonify({'error': '承認されたドラフトが見つかりません'}), 400
 
-    # Fallback: save without metadata
-    img.save(out_path)
+    # Prompts and settings were fixed at draft time: no further edits
+    session_id = _start_generation(
+        images, {}, None, False,
+        data.get('host', '127.0.0.1'), data.get('port', '7860'),
+    )
+    return jsonify({'session_id': session_id})
 
 
-def _add_event(session, event_type, data):
-    """Add an SSE event to the session queue."""
-    session['events'].append({
-        'event': event_type,
-        'data': data,
+def _start_generation(images, edits, sweep_axes, draft_mode, host, port):
+    """Queue a generation job for the worker process. Returns the session id."""
+    session_id = str(uuid.uuid4())
+    storage.create_session(session_id, {
+        'images': images,
+        'edits': edits,
+        'sweep': sweep_axes,
+        'draft': draft_mode,
+        'host': host,
+        'port': port,
+        'output_root': os.path.abspath(OUTPUT_DIR),
     })
+    return session_id
 
 
 @app.route('/api/generate/progress')
 def generate_progress():
     """SSE endpoint for generation progress."""
     session_id = request.args.get('session_id')
-    if not session_id or session_id not in generation_sessions:
+    if not session_id or not storage.session_exists(session_id):
         return jsonify({'error': 'セッションが見つかりません'}), 404
 
     def event_stream():
-        session = generation_sessions[session_id]
         sent = 0
 
         while True:
+            # Check before reading so no events are missed after 'done' is seen
+            done = storage.is_done(session_id)
+
             # Send any new events
-            while sent < len(session['events']):
-                evt = session['events'][sent]
-                yield f"event: {evt['event']}\ndata: {json.dumps(evt['data'], ensure_ascii=False)}\n\n"
-                sent += 1
+            for seq, event_type, data in storage.get_events(session_id, sent):
+                yield f"event: {event_type}\ndata: {json.dumps(data, ensure_ascii=False)}\n\n"
+                sent = seq
 
-            if session['done'] and sent >= len(session['events']):
-                # Clean up session after a delay
+            if done:
                 break
 
             # Polling interval
-            import time
-            time.sleep(0.3)
+            time.sleep(PROGRESS_POLL_INTERVAL)
 
         # Clean up
-        if session_id in generation_sessions:
-            del generation_sessions[session_id]
+        storage.delete_session(session_id)
 
     return Response(
         event_stream(),
@@ -333,10 +519,75 @@ def open_folder():
 
 @app.route('/api/output/<subdir>/<path:filename>')
 def serve_output(subdir, filename):
-    """Serve a generated image from the output directory."""
-    from flask import send_from_directory
+    """Serve a generated image (or a sweep's contact sheet/index) from the output directory.
+
+    Responses carry ETag/Last-Modified and support Range requests.
+    """
+    path = _output_path(subdir, filename)
+    if path is None or not os.path.isfile(path):
+        abort(404)
+    if filename.lower().endswith('.png'):
+        return send_file(path, mimetype='image/png', max_age=OUTPUT_MAX_AGE)
+    if filename == sweep.CONTACT_SHEET_FILE:
+        return send_file(path, mimetype='text/html')
+    if filename == sweep.INDEX_FILE:
+        return send_file(path, mimetype='application/x-ndjson')
+    abort(404)
+
+
+@app.route('/api/output-preview/<subdir>/<path:filename>')
+def serve_output_preview(subdir, filename):
+    """Serve the downscaled preview of a generated image, creating it on first request."""
+    image_path = _output_path(subdir, filename)
+    if image_path is None or not filename.lower().endswith('.png') or not os.path.isfile(image_path):
+        abort(404)
+    try:
+        path = previews.ensure_preview(image_path)
+    except OSError:
+        abort(404)
+    return send_file(path, mimetype='image/jpeg', max_age=OUTPUT_MAX_AGE)
+
+
+@app.route('/api/results/<subdir>')
+def list_results(subdir):
+    """List generated images in an output directory, paginated.
+
+    Query: page (1-based), per_page. Items carry full and preview URLs.
+    """
+    directory = _output_path(subdir)
+    if directory is None or not os.path.isdir(directory):
+        return jsonify({'error': 'ディレクトリが存在しません'}), 404
+    try:
+        page = max(1, int(request.args.get('page', 1)))
+        per_page = min(max(1, int(request.args.get('per_page', RESULTS_PAGE_SIZE))), RESULTS_MAX_PAGE_SIZE)
+    except ValueError:
+        return jsonify({'error': 'ページ指定が不正です'}), 400
+
+    files = previews.list_images(directory)
+    start = (page - 1) * per_page
+    return jsonify({
+        'page': page,
+        'per_page': per_page,
+        'total': len(files),
+        'pages': max(1, -(-len(files) // per_page)),
+        'files': files[start:start + per_page],
+    })
+
+
+def _output_path(subdir, filename=None):
+    """Resolve a path inside OUTPUT_DIR/<subdir>, or None if it escapes it.
+
+    Dot-directories and dot-files (.tmp, .previews, .state, ...) are internal
+    and never resolve.
+    """
+    if os.path.basename(subdir) != subdir or not subdir or subdir.startswith('.'):
+        return None
     directory = os.path.join(os.path.abspath(OUTPUT_DIR), subdir)
-    return send_from_directory(directory, filename, mimetype='image/png')
+    if filename is None:
+        return directory
+    if any(part.startswith('.') for part in filename.replace('\\', '/').split('/')):
+        return None
+    return safe_join(directory, filename)
 
 
 if __name__ == '__main__':
@@ -350,4 +601,7 @@ if __name__ == '__main__':
             print(f"  {_f}: {_mt}")
     print(f"  Port: {APP_PORT}")
     print("=" * 30)
+    # Local run: start the generation worker alongside the built-in server.
+    # Under a multi-worker WSGI server, run `python worker.py` separately instead.
+    multiprocessing.Process(target=worker.main, daemon=True).start()
     app.run(host='0.0.0.0', port=APP_PORT, debug=False)
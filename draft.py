@@ -0,0 +1,87 @@
+"""Draft (reduced-cost) generation settings and the draft manifest for final renders."""
+
+import json
+import os
+import re
+
+from metadata_parser import apply_settings
+
+DRAFT_STEPS_RATIO = 0.5
+DRAFT_MIN_STEPS = 10
+DRAFT_SIZE_RATIO = 0.5
+DRAFT_MIN_SIZE = 256
+SIZE_MULTIPLE = 8
+
+MANIFEST_FILE = 'drafts.jsonl'
+
+_re_size_suffix = re.compile(r'-[12]$')
+
+
+def draft_overrides(metadata: dict) -> dict:
+    """Settings overrides that make a render cheap but keep its seed.
+
+    - Hires fix is disabled by dropping every 'Hires ...' key and
+      'Denoising strength' (Forge enables hires fix from their presence).
+    - Steps are scaled by DRAFT_STEPS_RATIO (not below DRAFT_MIN_STEPS).
+    - Size is scaled by DRAFT_SIZE_RATIO, rounded to SIZE_MULTIPLE.
+    """
+    overrides = {}
+    for key in metadata:
+        if key.startswith('Hires ') or key == 'Denoising strength':
+            # 'Hires resize-1/-2' come from the single 'Hires resize' setting
+            overrides[_re_size_suffix.sub('', key)] = None
+
+    steps = metadata.get('Steps')
+    if isinstance(steps, int):
+        overrides['Steps'] = min(steps, max(DRAFT_MIN_STEPS, round(steps * DRAFT_STEPS_RATIO)))
+
+    width = metadata.get('Size-1')
+    height = metadata.get('Size-2')
+    if isinstance(width, int) and isinstance(height, int):
+        overrides['Size'] = f'{_scale_size(width)}x{_scale_size(height)}'
+
+    return overrides
+
+
+def _scale_size(size: int) -> int:
+    scaled = max(DRAFT_MIN_SIZE, round(size * DRAFT_SIZE_RATIO / SIZE_MULTIPLE) * SIZE_MULTIPLE)
+    return min(size, scaled)
+
+
+def apply_draft(metadata: dict) -> dict:
+    """Return a draft-quality copy of (edited) metadata."""
+    return apply_settings(metadata, draft_overrides(metadata))
+
+
+def with_seed(metadata: dict, seed: int | None) -> dict:
+    """Pin the seed actually used by a draft so the final render matches it."""
+    if seed is None or seed == metadata.get('Seed'):
+        return metadata
+    return apply_settings(metadata, {'Seed': seed})
+
+
+def append_manifest(out_dir: str, out_name: str, final_metadata: dict) -> None:
+    """Record the full-quality metadata behind one draft output."""
+    with open(os.path.join(out_dir, MANIFEST_FILE), 'a', encoding='utf-8') as f:
+        f.write(json.dumps({'file': out_name, 'metadata': final_metadata}, ensure_ascii=False) + '\n')
+
+
+def load_approved(out_dir: str, approved: list[str]) -> list[dict]:
+    """Read final-stage jobs for approved draft files, in manifest order.
+
+    Returns [{ filename, metadata }] where filename is the draft's output
+    path relative to its run directory, so final outputs mirror the layout.
+    A file listed more than once yields one job, from its last entry (the
+    render that is on disk).
+    """
+    manifest_path = os.path.join(out_dir, MANIFEST_FILE)
+    if not os.path.exists(manifest_path):
+        return []
+    approved = set(approved)
+    jobs = {}
+    with open(manifest_path, encoding='utf-8') as f:
+        for line in f:
+            entry = json.loads(line)
+            if entry['file'] in approved:
+                jobs[entry['file']] = {'filename': entry['file'], 'metadata': entry['metadata']}
+    return list(jobs.values())
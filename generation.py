@@ -0,0 +1,242 @@
+"""Batch generation job runner, executed by the generation worker process."""
+
+import base64
+import json
+import os
+import traceback
+from datetime import datetime
+from io import BytesIO
+
+from PIL import Image, PngImagePlugin
+
+from forge_client import ForgeClient
+from prompt_editor import apply_edits, RuleSet
+import sweep
+import draft
+import previews
+
+
+def compile_rules(edits):
+    """Compile the rule lists in an edit spec. Raises ValueError if invalid."""
+    rule_sets = {}
+    for side in ('positive', 'negative'):
+        rules = edits.get(f'rules_{side}') or []
+        if not isinstance(rules, list):
+            raise ValueError(f'rules_{side} must be a list')
+        rule_sets[side] = RuleSet(rules) if rules else None
+    return rule_sets
+
+
+def edit_prompt(prompt, side, edits, rule_sets):
+    """Apply rule rewrites, then tag removal/addition, to one prompt."""
+    if rule_sets.get(side) is not None:
+        prompt = rule_sets[side].apply(prompt)
+    return apply_edits(prompt, edits.get(f'remove_{side}', ''), edits.get(f'add_{side}', ''))
+
+
+def rule_hits(rule_sets):
+    """Per-rule hit counts for each side, for reporting."""
+    return {
+        side: rule_set.hit_counts() if rule_set is not None else []
+        for side, rule_set in rule_sets.items()
+    }
+
+
+def run_generation(storage, session_id, spec):
+    """Run one queued generation job, writing progress events to storage.
+
+    spec: { images, edits, sweep, draft, host, port, output_root } as queued
+    by the web tier (see app._start_generation).
+
+    Without a sweep, each input produces one output with the same filename.
+    With sweep_axes, each input is expanded lazily into grid variants saved
+    as <output>/<input stem>/<axis values>.png, plus a contact sheet.
+    In draft mode, jobs are rendered with draft.apply_draft settings and the
+    full-quality metadata (with the seed used) is kept in a manifest.
+    """
+    images = spec['images']
+    edits = spec.get('edits') or {}
+    rule_sets = compile_rules(edits)
+    sweep_axes = spec.get('sweep')
+    draft_mode = bool(spec.get('draft'))
+    client = ForgeClient(spec.get('host', '127.0.0.1'), spec.get('port', '7860'))
+
+    # Prepare output directory path (created on first successful generation).
+    # The session id keeps runs started within the same second apart.
+    timestamp = datetime.now().strftime('%Y%m%d%H%M%S')
+    out_dir = os.path.join(spec['output_root'], f'{timestamp}_{session_id[:8]}')
+    out_dir_created = False
+
+    # Group by model to minimize model switches
+    model_groups = {}
+    for img_data in images:
+        model_key = img_data['metadata'].get('Model', '') + '|' + img_data['metadata'].get('Model hash', '')
+        if model_key not in model_groups:
+            model_groups[model_key] = []
+        model_groups[model_key].append(img_data)
+
+    # Flatten back to ordered list (grouped by model), applying edits to prompts
+    ordered = []
+    for group in model_groups.values():
+        for img_data in group:
+            metadata = dict(img_data['metadata'])
+            metadata['positive_prompt'] = edit_prompt(
+                metadata.get('positive_prompt', ''), 'positive', edits, rule_sets,
+            )
+            metadata['negative_prompt'] = edit_prompt(
+                metadata.get('negative_prompt', ''), 'negative', edits, rule_sets,
+            )
+            ordered.append({'filename': img_data['filename'], 'metadata': metadata})
+
+    if sweep_axes:
+        jobs = sweep.iter_jobs(ordered, sweep_axes)
+        total = sweep.count_variants(len(ordered), sweep_axes)
+    else:
+        jobs = ({**img_data, 'out_name': img_data['filename']} for img_data in ordered)
+        total = len(ordered)
+
+    # Only counters are kept per run: outputs are listed from disk
+    # (/api/results) and, for sweeps, recorded in the sweep index
+    success = 0
+    failed = 0
+
+    for i, job in enumerate(jobs):
+        filename = job['filename']
+        out_name = job['out_name']
+        final_metadata = job['metadata']
+        metadata = draft.apply_draft(final_metadata) if draft_mode else final_metadata
+
+        # Send progress event
+        storage.add_event(session_id, 'progress', {
+            'current': i + 1,
+            'total': total,
+            'filename': filename,
+        })
+
+        try:
+            # Build payload and generate
+            payload = client.build_payload(metadata)
+            print(f"\n=== Payload for {filename} ===")
+            print(json.dumps({k: v for k, v in payload.items() if k != 'infotext'}, ensure_ascii=False, indent=2))
+            print(f"infotext:\n{payload.get('infotext', '(none)')}")
+            print("=" * 40)
+            result = client.txt2img(payload)
+
+            # Save image
+            if result.get('images'):
+                img_b64 = result['images'][0]
+                img_bytes = base64.b64decode(img_b64)
+
+                if not out_dir_created:
+                    os.makedirs(out_dir, exist_ok=True)
+                    out_dir_created = True
+                out_path = os.path.join(out_dir, out_name)
+                os.makedirs(os.path.dirname(out_path), exist_ok=True)
+                _save_image_with_metadata(img_bytes, out_path, result.get('info'))
+
+                success += 1
+                if draft_mode:
+                    seed = _result_seed(result.get('info'))
+                    draft.append_manifest(out_dir, out_name, draft.with_seed(final_metadata, seed))
+                if sweep_axes:
+                    sweep.append_index(out_dir, {
+                        'input': job['input'],
+                        'stem': job['stem'],
+                        'file': out_name,
+                        'values': job['values'],
+                    })
+                # Send payload info (without infotext raw text for brevity)
+                payload_info = {k: v for k, v in payload.items() if k not in ('infotext', 'send_images', 'save_images', 'override_settings_restore_afterwards')}
+                storage.add_event(session_id, 'image_done', {'filename': out_name, 'payload': payload_info})
+            else:
+                failed += 1
+                storage.add_event(session_id, 'error_event', {
+                    'filename': filename,
+                    'message': '画像データが返却されませんでした',
+                })
+
+        except Exception as e:
+            failed += 1
+            tb = traceback.format_exc()
+            print(f"\n!!! Error for {filename} !!!")
+            print(tb)
+            storage.add_event(session_id, 'error_event', {
+                'filename': filename,
+                'message': str(e),
+            })
+            # Stop on first error
+            break
+
+    contact_sheet = None
+    if sweep_axes and out_dir_created:
+        sheet_path = sweep.write_contact_sheet(out_dir, sweep_axes)
+        if sheet_path:
+            contact_sheet = os.path.basename(sheet_path)
+
+    # Complete
+    storage.add_event(session_id, 'complete', {
+        'output_dir': os.path.abspath(out_dir),
+        'output_subdir': os.path.basename(out_dir),
+        'total': total,
+        'success': success,
+        'failed': failed,
+        'rule_hits': rule_hits(rule_sets),
+        'contact_sheet': contact_sheet,
+        'draft': draft_mode,
+    })
+    storage.finish_session(session_id)
+
+
+def _result_seed(info_json) -> int | None:
+    """Return the seed Forge actually used, from the txt2img 'info' field."""
+    try:
+        info = json.loads(info_json) if isinstance(info_json, str) else info_json
+        seed = info.get('seed')
+    except (json.JSONDecodeError, AttributeError, TypeError):
+        return None
+    return seed if isinstance(seed, int) else None
+
+
+def _save_image_with_metadata(img_bytes: bytes, out_path: str, info_json: str | None):
+    """Save image bytes as PNG, preserving or restoring metadata.
+
+    Also writes the downscaled gallery preview while the image is decoded.
+    """
+    img = Image.open(BytesIO(img_bytes))
+    _save_png(img, out_path, info_json)
+    try:
+        previews.write_preview(img, out_path)
+    except OSError as e:
+        # Previews are recreated lazily on request; never fail the job for one
+        print(f"Preview write failed for {out_path}: {e}")
+
+
+def _save_png(img: Image.Image, out_path: str, info_json: str | None):
+    """Save an image as PNG with 'parameters' from the image or the API info."""
+    # Check if image already has parameters metadata
+    existing_params = img.info.get('parameters')
+    if existing_params:
+        # Already has metadata, save as-is
+        png_info = PngImagePlugin.PngInfo()
+        png_info.add_text('parameters', existing_params)
+        img.save(out_path, pnginfo=png_info)
+        return
+
+    # Try to restore from API response info
+    if info_json:
+        try:
+            if isinstance(info_json, str):
+                info = json.loads(info_json)
+            else:
+                info = info_json
+            infotxt = info.get('infotexts', [None])[0]
+            if infotxt:
+                png_info = PngImagePlugin.PngInfo()
+                png_info.add_text('parameters', infotxt)
+                img.save(out_path, pnginfo=png_info)
+                return
+        except (json.JSONDecodeError, KeyError, IndexError, TypeError):
+            pass
+
+    # Fallback: save without metadata
+    img.save(out_path)
@@ -1,6 +1,7 @@
 """PNG metadata parser - extracts and parses Stable Diffusion generation parameters."""
 
 import re
+import zlib
 from PIL import Image
 
 re_param = re.compile(r'\s*(\w[\w \-/]+):\s*("(?:\\.|[^\\"])+"|[^,]*)(?:,|$)')
@@ -23,6 +24,94 @@ def read_metadata(filepath: str) -> str | None:
         return None
 
 
+PNG_SIGNATURE = b'\x89PNG\r\n\x1a\n'
+
+
+class PngChunkReader:
+    """Incremental PNG chunk reader for streamed uploads.
+
+    Feed raw file bytes with feed() as they arrive. Text chunks
+    (tEXt/zTXt/iTXt) are decoded as they complete; other chunks are skipped
+    without buffering. Like Image.open(), only chunks before the first IDAT
+    are considered, so once image data begins the metadata is final.
+
+    Attributes:
+        parameters: The 'parameters' text, once seen.
+        done: True when no further metadata can appear.
+        error: Reason string if the stream is not a valid PNG.
+    """
+
+    def __init__(self):
+        self.parameters = None
+        self.done = False
+        self.error = None
+        self._buf = b''
+        self._signature_ok = False
+        self._skip = 0  # bytes of a non-text chunk (plus CRC) still to skip
+
+    def feed(self, data: bytes) -> None:
+        if self.done:
+            return
+        self._buf += data
+
+        if not self._signature_ok:
+            if len(self._buf) < len(PNG_SIGNATURE):
+                return
+            if not self._buf.startswith(PNG_SIGNATURE):
+                self.error = 'PNGファイルではありません'
+                self.done = True
+                return
+            self._buf = self._buf[len(PNG_SIGNATURE):]
+            self._signature_ok = True
+
+        while not self.done:
+            if self._skip:
+                n = min(self._skip, len(self._buf))
+                self._buf = self._buf[n:]
+                self._skip -= n
+                if self._skip:
+                    return
+            if len(self._buf) < 8:
+                return
+            length = int.from_bytes(self._buf[:4], 'big')
+            ctype = self._buf[4:8]
+            if ctype in (b'IDAT', b'IEND'):
+                self.done = True
+                self._buf = b''
+                return
+            if ctype not in (b'tEXt', b'zTXt', b'iTXt'):
+                self._buf = self._buf[8:]
+                self._skip = length + 4
+                continue
+            if len(self._buf) < 8 + length + 4:
+                return
+            self._read_text_chunk(ctype, self._buf[8:8 + length])
+            self._buf = self._buf[8 + length + 4:]
+
+    def _read_text_chunk(self, ctype: bytes, body: bytes) -> None:
+        key, _, value = body.partition(b'\x00')
+        if key != b'parameters':
+            return
+        try:
+            if ctype == b'tEXt':
+                text = value.decode('latin-1')
+            elif ctype == b'zTXt':
+                text = zlib.decompress(value[1:]).decode('latin-1')
+            else:
+                # iTXt: compression flag, method, language\0, translated keyword\0, text
+                compressed = value[0]
+                _lang, _, rest = value[2:].partition(b'\x00')
+                _tkey, _, text_bytes = rest.partition(b'\x00')
+                if compressed:
+                    text_bytes = zlib.decompress(text_bytes)
+                text = text_bytes.decode('utf-8')
+        except (zlib.error, UnicodeDecodeError, IndexError):
+            return
+        # Keep the first occurrence, matching PIL's img.info
+        if self.parameters is None:
+            self.parameters = text
+
+
 def is_sd_metadata(text: str) -> bool:
     """Check if the text looks like SD generation parameters (not ComfyUI/NovelAI)."""
     return 'Steps:' in text
@@ -127,6 +216,36 @@ def _clean_settings_line(line: str) -> str:
     return ', '.join(cleaned)
 
 
+def _quote(value: str) -> str:
+    """Quote a settings value the way A1111/Forge does when it contains separators."""
+    if ',' not in value and '\n' not in value and ':' not in value:
+        return value
+    return '"' + value.replace('\\', '\\\\').replace('"', '\\"') + '"'
+
+
+def replace_settings(original_raw: str, overrides: dict) -> str:
+    """Return raw infotext with values on the settings line replaced.
+
+    Existing keys keep their position; new keys are appended. A value of
+    None removes the key. 'Size' takes a 'WxH' string. Prompt lines are
+    left unchanged.
+    """
+    *content_lines, lastline = original_raw.strip().split("\n")
+    if len(re_param.findall(lastline)) < 3:
+        content_lines.append(lastline)
+        lastline = ''
+
+    pairs = {k.strip(): v.strip() for k, v in re_param.findall(lastline)}
+    for key, value in overrides.items():
+        if value is None:
+            pairs.pop(key, None)
+        else:
+            pairs[key] = _quote(str(value))
+
+    settings = ', '.join(f"{k}: {v}" for k, v in pairs.items())
+    return '\n'.join(content_lines + ([settings] if settings else []))
+
+
 def reconstruct_infotext(original_raw: str, new_positive: str, new_negative: str) -> str:
     """Reconstruct raw infotext text with edited prompts.
 
@@ -157,15 +276,44 @@ def reconstruct_infotext(original_raw: str, new_positive: str, new_negative: str
     return '\n'.join(parts)
 
 
-def extract_metadata(filepath: str) -> dict | None:
-    """Read a PNG file and extract parsed generation parameters.
+def metadata_from_text(raw: str | None) -> dict | None:
+    """Parse a raw parameters text into a metadata dict.
 
-    Returns None if the file has no valid SD metadata.
+    Returns None if the text is not valid SD metadata.
     The returned dict includes '_raw' key with the original parameters text.
     """
-    raw = read_metadata(filepath)
     if raw is None or not is_sd_metadata(raw):
         return None
     result = parse_generation_parameters(raw)
     result['_raw'] = raw
     return result
+
+
+def extract_metadata(filepath: str) -> dict | None:
+    """Read a PNG file and extract parsed generation parameters.
+
+    Returns None if the file has no valid SD metadata.
+    The returned dict includes '_raw' key with the original parameters text.
+    """
+    return metadata_from_text(read_metadata(filepath))
+
+
+def apply_settings(metadata: dict, settings: dict) -> dict:
+    """Return a copy of metadata with settings-line values overridden.
+
+    The overrides are written into the raw infotext (see replace_settings)
+    and re-parsed so metadata fields and infotext agree. The (possibly
+    edited) prompts in metadata are carried over unchanged.
+    """
+    result = dict(metadata)
+    if not settings:
+        return result
+    raw = metadata.get('_raw')
+    parsed = metadata_from_text(replace_settings(raw, settings)) if raw else None
+    if parsed is not None:
+        result = parsed
+    else:
+        result.update({k: v for k, v in settings.items() if v is not None})
+    result['positive_prompt'] = metadata.get('positive_prompt', '')
+    result['negative_prompt'] = metadata.get('negative_prompt', '')
+    return result
@@ -0,0 +1,106 @@
+"""Downscaled preview renditions of generated images, cached on disk.
+
+A preview for <dir>/<name>.png is stored at <dir>/.previews/<name>.jpg.
+Previews are written at save time and created lazily for older outputs.
+"""
+
+import os
+import threading
+import time
+import uuid
+from collections import OrderedDict
+
+from PIL import Image
+
+PREVIEW_SIZE = 384
+PREVIEW_QUALITY = 85
+PREVIEW_DIR = '.previews'
+
+# Per-process cache: root -> (directory mtimes, sorted listing), LRU-bounded
+LISTING_CACHE_SIZE = 32
+# Listings whose directories changed this recently are not cached: coarse
+# filesystem timestamps could hide a later change within the same tick
+LISTING_SETTLE_NS = 2_000_000_000
+_listing_cache = OrderedDict()
+_listing_cache_lock = threading.Lock()
+
+
+def preview_path(image_path: str) -> str:
+    directory, name = os.path.split(image_path)
+    return os.path.join(directory, PREVIEW_DIR, os.path.splitext(name)[0] + '.jpg')
+
+
+def write_preview(img: Image.Image, image_path: str) -> str:
+    """Write the preview for image_path from an already-open image."""
+    path = preview_path(image_path)
+    os.makedirs(os.path.dirname(path), exist_ok=True)
+    preview = img.convert('RGB')
+    preview.thumbnail((PREVIEW_SIZE, PREVIEW_SIZE))
+    # Write then rename so concurrent readers never see a partial file
+    tmp_path = f'{path}.{uuid.uuid4().hex}.tmp'
+    preview.save(tmp_path, format='JPEG', quality=PREVIEW_QUALITY)
+    os.replace(tmp_path, path)
+    return path
+
+
+def ensure_preview(image_path: str) -> str:
+    """Return the preview path, creating it if missing or older than the image."""
+    path = preview_path(image_path)
+    try:
+        if os.path.getmtime(path) >= os.path.getmtime(image_path):
+            return path
+    except OSError:
+        pass
+    with Image.open(image_path) as img:
+        return write_preview(img, image_path)
+
+
+def list_images(root: str) -> list[str]:
+    """List PNG files under root as sorted '/'-separated relative paths.
+
+    Preview cache directories are skipped. The listing is cached and reused
+    while no directory under root has changed (adding or removing a file
+    updates its directory's mtime), so paging through a large run only
+    stats its directories. The returned list must not be modified.
+    """
+    with _listing_cache_lock:
+        cached = _listing_cache.get(root)
+        if cached is not None:
+            _listing_cache.move_to_end(root)
+    if cached is not None and _unchanged(root, cached[0]):
+        return cached[1]
+
+    files = []
+    mtimes = {}
+    stack = ['']
+    while stack:
+        rel_dir = stack.pop()
+        path = os.path.join(root, rel_dir)
+        # Taken before scanning: a change during the scan invalidates the entry
+        mtimes[rel_dir] = os.stat(path).st_mtime_ns
+        with os.scandir(path) as it:
+            for entry in it:
+                rel = f'{rel_dir}/{entry.name}' if rel_dir else entry.name
+                if entry.is_dir():
+                    if entry.name != PREVIEW_DIR:
+                        stack.append(rel)
+                elif entry.name.lower().endswith('.png'):
+                    files.append(rel)
+    files.sort()
+
+    if time.time_ns() - max(mtimes.values()) > LISTING_SETTLE_NS:
+        with _listing_cache_lock:
+            _listing_cache[root] = (mtimes, files)
+            while len(_listing_cache) > LISTING_CACHE_SIZE:
+                _listing_cache.popitem(last=False)
+    return files
+
+
+def _unchanged(root: str, mtimes: dict) -> bool:
+    for rel_dir, mtime in mtimes.items():
+        try:
+            if os.stat(os.path.join(root, rel_dir)).st_mtime_ns != mtime:
+                return False
+        except OSError:
+            return False
+    return True
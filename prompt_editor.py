@@ -1,6 +1,7 @@
 """Prompt tokenizer and editor for Stable Diffusion prompts."""
 
 import re
+from difflib import SequenceMatcher
 
 
 def tokenize(prompt: str) -> list[str]:
@@ -168,3 +169,286 @@ def apply_edits(prompt: str, remove: str, add: str) -> str:
     result = remove_tags(prompt, remove_list)
     result = add_tags(result, add)
     return result
+
+
+def removal_cores(remove: str) -> list[str]:
+    """Normalize a comma-separated removal string into unique lowercase cores.
+
+    Order follows the input. Uses the same normalization as remove_tags.
+    """
+    cores = []
+    for tag in remove.split(','):
+        for sub_tag in tokenize(tag):
+            core = extract_core(sub_tag).lower()
+            if core not in cores:
+                cores.append(core)
+    return cores
+
+
+def matched_removals(prompt: str, remove: str) -> list[str]:
+    """Return the removal targets that actually match a token in the prompt.
+
+    Uses the same core matching as remove_tags. Each target is returned in
+    its normalized (lowercase core) form.
+    """
+    targets = removal_cores(remove)
+    if not targets:
+        return []
+    prompt_cores = {extract_core(t).lower() for t in tokenize(prompt)}
+    return [core for core in targets if core in prompt_cores]
+
+
+def diff_prompts(before: str, after: str) -> list[dict]:
+    """Compute a token-level diff between two prompts.
+
+    Returns a list of spans in prompt order, each
+    {'op': 'equal' | 'removed' | 'added', 'tokens': [...]}.
+    A replaced run is reported as a removed span followed by an added span.
+    """
+    a = tokenize(before)
+    b = tokenize(after)
+    spans = []
+    for op, i1, i2, j1, j2 in SequenceMatcher(a=a, b=b, autojunk=False).get_opcodes():
+        if op == 'equal':
+            spans.append({'op': 'equal', 'tokens': a[i1:i2]})
+            continue
+        if i2 > i1:
+            spans.append({'op': 'removed', 'tokens': a[i1:i2]})
+        if j2 > j1:
+            spans.append({'op': 'added', 'tokens': b[j1:j2]})
+    return spans
+
+
+# --- Rule engine ---
+#
+# A rule is a dict with a 'type' and, for token rules, exactly one matcher:
+#   'tag': exact core match (case-insensitive, brackets/weights ignored)
+#   'wildcard': core match with * and ? wildcards
+#   'regex': core match with a regular expression (full match, case-insensitive)
+#
+# Wildcard and regex rules without capturing groups or leading inline flags
+# such as (?i) share one combined regex. Rules that use groups (and therefore
+# backreferences) or inline flags keep their own meaning but are tried one at
+# a time, so prefer (?:...) groups in large rule sets.
+#
+# Rule types:
+#   {'type': 'remove', <matcher>}
+#   {'type': 'reweight', <matcher>, 'weight': 0.9}
+#   {'type': 'replace', <matcher>, 'with': 'new tag'}
+#   {'type': 'lora', 'name': 'old', 'to': 'new', 'weight': 0.6 | 'scale': 0.75}
+#   {'type': 'insert', 'tags': 'a, b', 'position': 'start' | 'end' | 'before' | 'after',
+#    'anchor': 'tag'}
+
+RULE_TYPES = ('remove', 'reweight', 'replace', 'lora', 'insert')
+_MATCHERS = ('tag', 'wildcard', 'regex')
+_INSERT_POSITIONS = ('start', 'end', 'before', 'after')
+
+# Global inline flags, e.g. (?i) or (?sx), only valid at the start of a pattern
+_re_inline_flags = re.compile(r'^\(\?[aiLmsux]+\)')
+
+# <lora:name>, <lora:name:0.8>, <lyco:name:0.8:0.5>
+_re_lora = re.compile(r'^<(lora|lyco):([^:>]+)(?::([^:>]*))?(:[^>]*)?>$', re.IGNORECASE)
+
+
+def _format_weight(weight: float) -> str:
+    return format(round(weight, 4), 'g')
+
+
+def _wildcard_to_regex(pattern: str) -> str:
+    return re.escape(pattern).replace(r'\*', '.*').replace(r'\?', '.')
+
+
+def _normalize_tag(tag: str) -> str:
+    tokens = tokenize(tag)
+    return extract_core(tokens[0]).lower() if tokens else ''
+
+
+class RuleSet:
+    """A compiled set of prompt rewrite rules, applied in one pass per prompt.
+
+    Token rules are indexed by matcher kind: exact tags in a dict keyed by
+    lowercase core, LoRA names in a dict keyed by lowercase name, and
+    wildcard/regex rules in one combined regex (except those that cannot be
+    combined, see above, which are tried separately). When several rules match a
+    token, the one listed first wins. Insert rules are keyed by anchor core
+    and applied while walking the same token list.
+
+    hits[i] counts how many times rule i was applied, across all apply() calls.
+    Raises ValueError for invalid rules.
+    """
+
+    def __init__(self, rules: list[dict]):
+        self.rules = list(rules)
+        self.hits = [0] * len(self.rules)
+        self._exact = {}        # core -> rule index
+        self._lora = {}         # lora name -> rule index
+        self._anchors = {}      # core -> [(position, rule index)]
+        self._edges = []        # [(position, rule index)] for start/end inserts
+        self._inserts = {}      # rule index -> tokens to insert
+        self._pattern = None    # combined wildcard/regex matcher
+        self._solo = []         # [(rule index, regex)] that cannot join the combined one
+        patterns = []
+
+        for i, rule in enumerate(self.rules):
+            if not isinstance(rule, dict):
+                raise ValueError(f'rule {i}: must be an object')
+            rtype = rule.get('type')
+            if rtype not in RULE_TYPES:
+                raise ValueError(f'rule {i}: unknown type {rtype!r}')
+
+            if rtype == 'insert':
+                self._compile_insert(i, rule)
+                continue
+
+            if rtype == 'lora':
+                self._require_string(i, rule, 'name')
+                self._require_string(i, rule, 'to', optional=True)
+                for key in ('weight', 'scale'):
+                    if rule.get(key) is not None:
+                        self._require_number(i, rule, key)
+                self._lora.setdefault(rule['name'].strip().lower(), i)
+                continue
+
+            if rtype == 'reweight':
+                self._require_number(i, rule, 'weight')
+            if rtype == 'replace' and not isinstance(rule.get('with'), str):
+                raise ValueError(f'rule {i}: replace rule needs a "with" string')
+
+            matchers = [k for k in _MATCHERS if rule.get(k) is not None]
+            if len(matchers) != 1:
+                raise ValueError(f'rule {i}: specify exactly one of {", ".join(_MATCHERS)}')
+            kind = matchers[0]
+            self._require_string(i, rule, kind)
+            if kind == 'tag':
+                self._exact.setdefault(_normalize_tag(rule['tag']), i)
+                continue
+            source = _wildcard_to_regex(rule['wildcard']) if kind == 'wildcard' else rule['regex']
+            try:
+                compiled = re.compile(source, re.IGNORECASE)
+            except re.error as e:
+                raise ValueError(f'rule {i}: invalid regex: {e}') from None
+            if compiled.groups or _re_inline_flags.match(source):
+                # Group numbers/backreferences and global flags change meaning
+                # inside the combined alternation
+                self._solo.append((i, compiled))
+            else:
+                patterns.append(f'(?P<r{i}>{source})')
+
+        if patterns:
+            self._pattern = re.compile('|'.join(patterns), re.IGNORECASE)
+
+    @staticmethod
+    def _require_number(i: int, rule: dict, key: str) -> None:
+        value = rule.get(key)
+        if isinstance(value, bool) or not isinstance(value, (int, float)):
+            raise ValueError(f'rule {i}: "{key}" must be a number')
+
+    @staticmethod
+    def _require_string(i: int, rule: dict, key: str, optional: bool = False) -> None:
+        value = rule.get(key)
+        if optional and value is None:
+            return
+        if not isinstance(value, str) or not value.strip():
+            raise ValueError(f'rule {i}: "{key}" must be a non-empty string')
+
+    def _compile_insert(self, i: int, rule: dict) -> None:
+        self._require_string(i, rule, 'tags')
+        tokens = tokenize(rule['tags'])
+        if not tokens:
+            raise ValueError(f'rule {i}: insert rule needs tags')
+        position = rule.get('position', 'start')
+        if position not in _INSERT_POSITIONS:
+            raise ValueError(f'rule {i}: unknown position {position!r}')
+        self._inserts[i] = tokens
+        if position in ('start', 'end'):
+            self._edges.append((position, i))
+            return
+        self._require_string(i, rule, 'anchor')
+        anchor = _normalize_tag(rule['anchor'])
+        if not anchor:
+            raise ValueError(f'rule {i}: {position} insert needs an anchor')
+        self._anchors.setdefault(anchor, []).append((position, i))
+
+    def _match(self, token: str, core: str) -> int | None:
+        """Return the index of the first rule matching a token, or None."""
+        candidates = []
+        exact = self._exact.get(core.lower())
+        if exact is not None:
+            candidates.append(exact)
+        m = _re_lora.match(core)
+        if m:
+            lora = self._lora.get(m.group(2).strip().lower())
+            if lora is not None:
+                candidates.append(lora)
+        if self._pattern is not None:
+            pm = self._pattern.fullmatch(core)
+            if pm:
+                candidates.append(int(pm.lastgroup[1:]))
+        best = min(candidates) if candidates else None
+        for i, regex in self._solo:
+            if best is not None and i > best:
+                break
+            if regex.fullmatch(core):
+                return i
+        return best
+
+    def _rewrite(self, rule: dict, token: str, core: str) -> str | None:
+        """Apply a token rule. Returns the new token, or None to drop it."""
+        rtype = rule['type']
+        if rtype == 'remove':
+            return None
+        if rtype == 'replace':
+            return rule['with'].strip() or None
+        m = _re_lora.match(core)
+        if rtype == 'lora' or (rtype == 'reweight' and m):
+            kind, name, weight, extra = m.groups()
+            if rtype == 'lora':
+                name = rule.get('to') or name
+                if rule.get('weight') is not None:
+                    weight = _format_weight(rule['weight'])
+                elif rule.get('scale') is not None and weight:
+                    try:
+                        weight = _format_weight(float(weight) * rule['scale'])
+                    except ValueError:
+                        pass
+            else:
+                weight = _format_weight(rule['weight'])
+            return f'<{kind}:{name}' + (f':{weight}' if weight else '') + (extra or '') + '>'
+        # reweight
+        return f'({core}:{_format_weight(rule["weight"])})'
+
+    def apply(self, prompt: str) -> str:
+        """Rewrite a prompt with every rule in a single pass over its tokens."""
+        result = []
+        for token in tokenize(prompt):
+            core = extract_core(token)
+            anchored = self._anchors.get(core.lower(), ())
+            for position, i in anchored:
+                if position == 'before':
+                    result.extend(self._inserts[i])
+                    self.hits[i] += 1
+
+            i = self._match(token, core)
+            if i is None:
+                result.append(token)
+            else:
+                self.hits[i] += 1
+                new_token = self._rewrite(self.rules[i], token, core)
+                if new_token is not None:
+                    result.append(new_token)
+
+            for position, i in anchored:
+                if position == 'after':
+                    result.extend(self._inserts[i])
+                    self.hits[i] += 1
+
+        head = []
+        for position, i in self._edges:
+            (head if position == 'start' else result).extend(self._inserts[i])
+            self.hits[i] += 1
+
+        return tokens_to_prompt(head + result)
+
+    def hit_counts(self) -> list[dict]:
+        """Return [{'rule': rule, 'hits': n}, ...] in rule order."""
+        return [{'rule': rule, 'hits': n} for rule, n in zip(self.rules, self.hits)]
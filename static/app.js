@@ -21,7 +21,7 @@ function showToast(message, type = 'info') {
     setTimeout(() => toast.remove(), 3000);
 }
 
-// --- Tokenizer (mirrors prompt_editor.py) ---
+// --- Tokenizer (mirrors prompt_editor.py, used for common tag display) ---
 
 function tokenize(prompt) {
     const tokens = [];
@@ -60,34 +60,6 @@ function extractCore(token) {
     return t;
 }
 
-function removeTags(prompt, tagsToRemove) {
-    if (!tagsToRemove.length) return prompt;
-    const removeCores = new Set();
-    for (const tag of tagsToRemove) {
-        for (const sub of tokenize(tag)) {
-            removeCores.add(extractCore(sub).toLowerCase());
-        }
-    }
-    const tokens = tokenize(prompt);
-    const filtered = tokens.filter(t => !removeCores.has(extractCore(t).toLowerCase()));
-    return filtered.join(', ');
-}
-
-function addTags(prompt, tagsToAdd) {
-    tagsToAdd = tagsToAdd.trim();
-    if (!tagsToAdd) return prompt;
-    prompt = prompt.trim();
-    if (!prompt) return tagsToAdd;
-    return tagsToAdd + ', ' + prompt;
-}
-
-function applyEdits(prompt, remove, add) {
-    const removeList = remove.split(',').map(t => t.trim()).filter(Boolean);
-    let result = removeTags(prompt, removeList);
-    result = addTags(result, add);
-    return result;
-}
-
 function findCommonTags(prompts) {
     if (!prompts.length) return [];
     const tagSets = prompts.map(p => {
@@ -140,37 +112,71 @@ function updateForgeStatus() {
 
 // --- Image Upload ---
 
+const UPLOAD_BATCH_SIZE = 100;
+
 async function uploadFiles(files) {
+    const pngFiles = [];
     for (const file of files) {
         if (file.type !== 'image/png') {
             showToast(`${file.name}: PNGファイルのみ対応`, 'error');
             continue;
         }
+        pngFiles.push(file);
+    }
 
+    // Send files in batches; each batch is one multipart request whose
+    // results are streamed back as NDJSON lines
+    for (let i = 0; i < pngFiles.length; i += UPLOAD_BATCH_SIZE) {
+        const batch = pngFiles.slice(i, i + UPLOAD_BATCH_SIZE);
         const formData = new FormData();
-        formData.append('file', file);
+        for (const file of batch) formData.append('files', file);
 
         try {
-            const resp = await fetch('/api/upload', { method: 'POST', body: formData });
-            const data = await resp.json();
-
-            if (data.error) {
-                showToast(`${file.name}: ${data.error}`, 'error');
+            const resp = await fetch('/api/upload/batch', { method: 'POST', body: formData });
+            if (!resp.ok) {
+                const data = await resp.json();
+                showToast(data.error || 'アップロード失敗', 'error');
                 continue;
             }
-
-            state.images.push({
-                id: data.id,
-                filename: data.filename,
-                thumbnail: data.thumbnail,
-                metadata: data.metadata,
-            });
+            await readNdjson(resp, handleUploadResult);
         } catch (e) {
-            showToast(`${file.name}: アップロード失敗`, 'error');
+            showToast(`${batch.length}件のアップロード失敗`, 'error');
         }
+        renderImages();
+        renderCommonTags();
     }
-    renderImages();
-    renderCommonTags();
+}
+
+function handleUploadResult(data) {
+    if (data.error) {
+        showToast(`${data.filename}: ${data.error}`, 'error');
+        return;
+    }
+    // Identical files are deduplicated server-side and share an id
+    if (state.images.some(img => img.id === data.id)) return;
+    state.images.push({
+        id: data.id,
+        filename: data.filename,
+        thumbnail: data.thumbnail,
+        metadata: data.metadata,
+    });
+}
+
+async function readNdjson(resp, onItem) {
+    const reader = resp.body.getReader();
+    const decoder = new TextDecoder();
+    let buffer = '';
+    while (true) {
+        const { done, value } = await reader.read();
+        if (done) break;
+        buffer += decoder.decode(value, { stream: true });
+        const lines = buffer.split('\n');
+        buffer = lines.pop();
+        for (const line of lines) {
+            if (line.trim()) onItem(JSON.parse(line));
+        }
+    }
+    if (buffer.trim()) onItem(JSON.parse(buffer));
 }
 
 function removeImage(id) {
@@ -253,35 +259,145 @@ function escapeHtml(str) {
 
 // --- Preview ---
 
-function showPreview() {
-    const removePos = $('#edit-remove-pos').value;
-    const removeNeg = $('#edit-remove-neg').value;
-    const addPos = $('#edit-add-pos').value;
-    const addNeg = $('#edit-add-neg').value;
+const PREVIEW_PAGE_SIZE = 50;
 
+// Read the sweep JSON textarea. Returns the spec, undefined when empty,
+// or null (after showing an error) if the JSON is invalid.
+function getSweep() {
+    const text = $('#edit-sweep').value.trim();
+    if (!text) return undefined;
+    try {
+        return JSON.parse(text);
+    } catch (e) {
+        showToast(`スイープのJSONが不正です: ${e.message}`, 'error');
+        return null;
+    }
+}
+
+// Read the rule JSON textarea. Returns { rules_positive, rules_negative },
+// or null (after showing an error) if the JSON is invalid.
+function getRules() {
+    const text = $('#edit-rules').value.trim();
+    if (!text) return { rules_positive: [], rules_negative: [] };
+    try {
+        const rules = JSON.parse(text);
+        return {
+            rules_positive: rules.positive || [],
+            rules_negative: rules.negative || [],
+        };
+    } catch (e) {
+        showToast(`ルールのJSONが不正です: ${e.message}`, 'error');
+        return null;
+    }
+}
+
+async function showPreview(page = 1) {
     const previewList = $('.preview-list');
     const previewSection = $('#preview-section');
     previewSection.classList.remove('hidden');
 
     if (state.images.length === 0) {
+        $('.preview-summary').innerHTML = '';
+        $('.preview-pager').innerHTML = '';
         previewList.innerHTML = '<p class="no-images">画像がありません</p>';
         return;
     }
 
-    previewList.innerHTML = state.images.map(img => {
-        const newPos = applyEdits(img.metadata.positive_prompt, removePos, addPos);
-        const newNeg = applyEdits(img.metadata.negative_prompt, removeNeg, addNeg);
+    const rules = getRules();
+    if (!rules) return;
 
-        return `
-            <div class="preview-item">
-                <div class="preview-filename">${escapeHtml(img.filename)}</div>
-                <div class="preview-label">Positive:</div>
-                <div class="preview-text">${escapeHtml(newPos)}</div>
-                <div class="preview-label">Negative:</div>
-                <div class="preview-text">${escapeHtml(newNeg)}</div>
-            </div>
-        `;
-    }).join('');
+    let data;
+    try {
+        const resp = await fetch('/api/preview', {
+            method: 'POST',
+            headers: { 'Content-Type': 'application/json' },
+            body: JSON.stringify({
+                image_ids: state.images.map(img => img.id),
+                edits: {
+                    remove_positive: $('#edit-remove-pos').value,
+                    remove_negative: $('#edit-remove-neg').value,
+                    add_positive: $('#edit-add-pos').value,
+                    add_negative: $('#edit-add-neg').value,
+                    ...rules,
+                },
+                page,
+                per_page: PREVIEW_PAGE_SIZE,
+            }),
+        });
+        data = await resp.json();
+    } catch (e) {
+        showToast('プレビュー取得失敗', 'error');
+        return;
+    }
+    if (data.error) {
+        showToast(data.error, 'error');
+        return;
+    }
+
+    renderPreviewSummary(data.summary);
+    renderPreviewPager(data);
+    previewList.innerHTML = data.items.map(item => `
+        <div class="preview-item">
+            <div class="preview-filename">${escapeHtml(item.filename)}</div>
+            <div class="preview-label">Positive: (-${item.positive.removed} / +${item.positive.added})</div>
+            <div class="preview-text">${renderDiff(item.positive.diff)}</div>
+            <div class="preview-label">Negative: (-${item.negative.removed} / +${item.negative.added})</div>
+            <div class="preview-text">${renderDiff(item.negative.diff)}</div>
+        </div>
+    `).join('');
+    previewList.scrollTop = 0;
+}
+
+function renderDiff(spans) {
+    const parts = [];
+    for (const span of spans) {
+        for (const token of span.tokens) {
+            const text = escapeHtml(token);
+            if (span.op === 'removed') parts.push(`<span class="diff-removed">${text}</span>`);
+            else if (span.op === 'added') parts.push(`<span class="diff-added">${text}</span>`);
+            else parts.push(text);
+        }
+    }
+    return parts.join(', ');
+}
+
+function renderPreviewSummary(summary) {
+    const hitsHtml = (label, hits) => {
+        const entries = Object.entries(hits);
+        if (!entries.length) return '';
+        return `<div><span class="preview-label">${label}:</span> ` +
+            entries.map(([tag, n]) =>
+                `<span class="tag${n === 0 ? ' tag-unmatched' : ''}">${escapeHtml(tag)}: ${n}</span>`
+            ).join(' ') + '</div>';
+    };
+    const ruleHitsHtml = (label, ruleHits) => {
+        if (!ruleHits || !ruleHits.length) return '';
+        return `<div><span class="preview-label">${label}:</span> ` +
+            ruleHits.map(({ rule, hits }, i) =>
+                `<span class="tag${hits === 0 ? ' tag-unmatched' : ''}" title="${escapeHtml(JSON.stringify(rule))}">#${i} ${escapeHtml(rule.type)}: ${hits}</span>`
+            ).join(' ') + '</div>';
+    };
+    $('.preview-summary').innerHTML =
+        `<div>変更あり: ${summary.changed} / ${summary.images}枚</div>` +
+        hitsHtml('削除 Positive', summary.remove_positive) +
+        hitsHtml('削除 Negative', summary.remove_negative) +
+        ruleHitsHtml('ルール Positive', summary.rule_hits.positive) +
+        ruleHitsHtml('ルール Negative', summary.rule_hits.negative);
+}
+
+function renderPreviewPager(data) {
+    const pager = $('.preview-pager');
+    if (data.pages <= 1) {
+        pager.innerHTML = '';
+        return;
+    }
+    pager.innerHTML = `
+        <button class="btn-secondary" id="preview-prev" ${data.page <= 1 ? 'disabled' : ''}>&lt;</button>
+        <span>${data.page} / ${data.pages}</span>
+        <button class="btn-secondary" id="preview-next" ${data.page >= data.pages ? 'disabled' : ''}>&gt;</button>
+    `;
+    $('#preview-prev').addEventListener('click', () => showPreview(data.page - 1));
+    $('#preview-next').addEventListener('click', () => showPreview(data.page + 1));
 }
 
 // --- Generation ---
@@ -301,25 +417,18 @@ async function startGeneration() {
     const addPos = $('#edit-add-pos').value;
     const addNeg = $('#edit-add-neg').value;
 
-    if (!removePos && !removeNeg && !addPos && !addNeg) {
+    const rules = getRules();
+    if (!rules) return;
+    const sweep = getSweep();
+    if (sweep === null) return;
+
+    if (!removePos && !removeNeg && !addPos && !addNeg && !sweep
+        && !rules.rules_positive.length && !rules.rules_negative.length) {
         showToast('編集内容を入力してください', 'error');
         return;
     }
 
-    state.generating = true;
-    state.lastPayloads = {};
-    $('#btn-generate').disabled = true;
-
-    // Hide previous results
-    $('#results-section').classList.add('hidden');
-
-    // Show progress section
-    const progressSection = $('.progress-section');
-    progressSection.classList.add('active');
-    $('.progress-bar').style.width = '0%';
-    $('.progress-bar').textContent = '0%';
-    $('.progress-status').textContent = '生成開始中...';
-    $('.progress-log').innerHTML = '';
+    beginGeneration();
 
     try {
         const resp = await fetch('/api/generate', {
@@ -338,7 +447,10 @@ async function startGeneration() {
                     remove_negative: removeNeg,
                     add_positive: addPos,
                     add_negative: addNeg,
+                    ...rules,
                 },
+                sweep,
+                draft: $('#draft-mode').checked,
             }),
         });
 
@@ -359,6 +471,67 @@ async function startGeneration() {
     }
 }
 
+// Payloads shown on result cards; later outputs of very large runs go without
+const MAX_KEPT_PAYLOADS = 500;
+
+function beginGeneration() {
+    state.generating = true;
+    state.lastPayloads = {};
+    state.keptPayloads = 0;
+    $('#btn-generate').disabled = true;
+
+    // Hide previous results
+    $('#results-section').classList.add('hidden');
+
+    // Show progress section
+    const progressSection = $('.progress-section');
+    progressSection.classList.add('active');
+    $('.progress-bar').style.width = '0%';
+    $('.progress-bar').textContent = '0%';
+    $('.progress-status').textContent = '生成開始中...';
+    $('.progress-log').innerHTML = '';
+}
+
+// Render approved drafts at full quality (same prompts, settings and seeds)
+async function startFinalGeneration(outputSubdir) {
+    if (state.generating) return;
+
+    const files = [...$$('.approve-check:checked')].map(el => el.dataset.file);
+    if (!files.length) {
+        showToast('本生成する画像を選択してください', 'error');
+        return;
+    }
+
+    beginGeneration();
+
+    try {
+        const resp = await fetch('/api/generate/final', {
+            method: 'POST',
+            headers: { 'Content-Type': 'application/json' },
+            body: JSON.stringify({
+                host: $('#forge-host').value.trim(),
+                port: $('#forge-port').value.trim(),
+                output_subdir: outputSubdir,
+                files,
+            }),
+        });
+
+        const data = await resp.json();
+        if (data.error) {
+            showToast(data.error, 'error');
+            state.generating = false;
+            $('#btn-generate').disabled = false;
+            return;
+        }
+
+        connectSSE(data.session_id);
+    } catch (e) {
+        showToast('本生成リクエスト失敗', 'error');
+        state.generating = false;
+        $('#btn-generate').disabled = false;
+    }
+}
+
 function connectSSE(sessionId) {
     if (state.eventSource) {
         state.eventSource.close();
@@ -378,9 +551,9 @@ function connectSSE(sessionId) {
     es.addEventListener('image_done', (e) => {
         const data = JSON.parse(e.data);
         addLogEntry(`${data.filename} - 完了`, 'success');
-        if (data.payload) {
-            state.lastPayloads = state.lastPayloads || {};
+        if (data.payload && state.keptPayloads < MAX_KEPT_PAYLOADS) {
             state.lastPayloads[data.filename] = data.payload;
+            state.keptPayloads++;
         }
     });
 
@@ -425,17 +598,28 @@ function connectSSE(sessionId) {
     };
 }
 
+// Older log lines are dropped so long sweeps keep a bounded log
+const MAX_LOG_ENTRIES = 500;
+
 function addLogEntry(text, type = '') {
     const log = $('.progress-log');
     const entry = document.createElement('div');
     entry.className = `log-entry ${type}`;
     entry.textContent = text;
     log.appendChild(entry);
+    while (log.childElementCount > MAX_LOG_ENTRIES) log.firstElementChild.remove();
     log.scrollTop = log.scrollHeight;
 }
 
 // --- Results ---
 
+const RESULTS_PAGE_SIZE = 60;
+
+function outputUrl(route, subdir, file) {
+    // Sweep outputs are nested (<input stem>/<variant>.png): encode per segment
+    return `/api/${route}/${encodeURIComponent(subdir)}/${file.split('/').map(encodeURIComponent).join('/')}`;
+}
+
 function showResults(data) {
     const section = $('#results-section');
     section.classList.remove('hidden');
@@ -444,22 +628,87 @@ function showResults(data) {
     const dirEl = $('#results-output-dir');
     state.lastOutputDir = data.output_dir;
     dirEl.innerHTML = `<a id="open-output-dir">${escapeHtml(data.output_dir)}</a>`;
+    if (data.contact_sheet) {
+        const sheetUrl = `/api/output/${encodeURIComponent(data.output_subdir)}/${encodeURIComponent(data.contact_sheet)}`;
+        dirEl.innerHTML += ` / <a href="${sheetUrl}" target="_blank">コンタクトシート</a>`;
+    }
     document.getElementById('open-output-dir').addEventListener('click', () => {
         openFolder(data.output_dir);
     });
 
-    // Image grid
-    const grid = $('#results-grid');
     const subdir = data.output_subdir;
+
+    // Draft results: approve a subset for the full-quality stage
+    const actions = $('#results-actions');
+    if (data.draft && data.success > 0) {
+        actions.innerHTML = `
+            <button class="btn-secondary" id="btn-approve-all">表示中を全選択</button>
+            <button class="btn-primary" id="btn-final">承認した画像を本生成</button>
+        `;
+        actions.classList.remove('hidden');
+        $('#btn-approve-all').addEventListener('click', () => {
+            for (const el of $$('.approve-check')) el.checked = true;
+        });
+        $('#btn-final').addEventListener('click', () => startFinalGeneration(subdir));
+    } else {
+        actions.innerHTML = '';
+        actions.classList.add('hidden');
+    }
+
+    // Image grid: loaded page by page from the listing API as the user scrolls
+    $('#results-grid').innerHTML = '';
+    state.results = { subdir, draft: data.draft, nextPage: 1, pages: 1, loading: false };
+    if (subdir && data.success > 0) {
+        loadResultsPage();
+    }
+
+    section.scrollIntoView({ behavior: 'smooth' });
+}
+
+async function loadResultsPage() {
+    const results = state.results;
+    if (!results || results.loading || results.nextPage > results.pages) return;
+    results.loading = true;
+
+    let data;
+    try {
+        const resp = await fetch(`/api/results/${encodeURIComponent(results.subdir)}?page=${results.nextPage}&per_page=${RESULTS_PAGE_SIZE}`);
+        data = await resp.json();
+    } catch (e) {
+        showToast('結果一覧の取得に失敗しました', 'error');
+        results.loading = false;
+        return;
+    }
+    results.loading = false;
+    // Ignore responses for a result set that has since been replaced
+    if (state.results !== results) return;
+    if (data.error) {
+        showToast(data.error, 'error');
+        return;
+    }
+
+    results.pages = data.pages;
+    results.nextPage = data.page + 1;
+    appendResultCards(results, data.files);
+    const more = $('#results-more');
+    more.classList.toggle('hidden', results.nextPage > results.pages);
+    // The observer only fires on visibility changes: keep loading while the sentinel stays in view
+    if (!more.classList.contains('hidden') && more.getBoundingClientRect().top < window.innerHeight + 400) {
+        loadResultsPage();
+    }
+}
+
+function appendResultCards(results, files) {
+    const grid = $('#results-grid');
     const payloads = state.lastPayloads || {};
 
-    grid.innerHTML = (data.files || []).map(f => {
-        const src = `/api/output/${encodeURIComponent(subdir)}/${encodeURIComponent(f)}`;
+    grid.insertAdjacentHTML('beforeend', files.map(f => {
+        const src = outputUrl('output', results.subdir, f);
+        const previewSrc = outputUrl('output-preview', results.subdir, f);
         const payload = payloads[f];
-        const payloadId = 'payload-' + Math.random().toString(36).slice(2);
         let payloadHtml = '';
         if (payload) {
-            payloadHtml = `<div class="result-payload" id="${payloadId}">` +
+            payloadHtml = `<div class="result-payload">` +
                 `<div class="payload-row"><span class="payload-label">Positive:</span> <span class="payload-value">${escapeHtml(payload.prompt || '')}</span></div>` +
                 `<div class="payload-row"><span class="payload-label">Negative:</span> <span class="payload-value">${escapeHtml(payload.negative_prompt || '')}</span></div>`;
             const settings = Object.entries(payload)
@@ -471,23 +720,17 @@ function showResults(data) {
             }
             payloadHtml += '</div>';
         }
+        const approveHtml = results.draft
+            ? `<label class="result-approve"><input type="checkbox" class="approve-check" data-file="${escapeHtml(f)}"> 承認</label>`
+            : '';
         return `
             <div class="result-card">
-                <img src="${src}" alt="${escapeHtml(f)}" loading="lazy" data-src="${src}" data-filename="${escapeHtml(f)}" class="result-img">
-                <div class="result-filename" title="${escapeHtml(f)}">${escapeHtml(f)}</div>
+                <img src="${previewSrc}" alt="${escapeHtml(f)}" loading="lazy" data-src="${src}" data-filename="${escapeHtml(f)}" class="result-img">
+                <div class="result-filename" title="${escapeHtml(f)}">${escapeHtml(f)}${approveHtml}</div>
                 ${payloadHtml}
             </div>
         `;
-    }).join('');
-
-    // Attach click handlers for modal
-    for (const img of grid.querySelectorAll('.result-img')) {
-        img.addEventListener('click', () => {
-            openModal(img.dataset.src, img.dataset.filename);
-        });
-    }
-
-    section.scrollIntoView({ behavior: 'smooth' });
+    }).join(''));
 }
 
 async function openFolder(path) {
@@ -551,9 +794,18 @@ document.addEventListener('DOMContentLoaded', () => {
         input.click();
     });
 
+    // Results: full-size image in modal, next page when the sentinel scrolls into view
+    $('#results-grid').addEventListener('click', (e) => {
+        const img = e.target.closest('.result-img');
+        if (img) openModal(img.dataset.src, img.dataset.filename);
+    });
+    new IntersectionObserver((entries) => {
+        if (entries.some(entry => entry.isIntersecting)) loadResultsPage();
+    }, { rootMargin: '400px' }).observe($('#results-more'));
+
     // Buttons
     $('#clear-all-btn').addEventListener('click', clearAllImages);
-    $('#btn-preview').addEventListener('click', showPreview);
+    $('#btn-preview').addEventListener('click', () => showPreview(1));
     $('#btn-generate').addEventListener('click', startGeneration);
 
     // Forge connection check
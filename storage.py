@@ -0,0 +1,263 @@
+"""Shared state for uploads, generation sessions and progress events.
+
+All web workers and the generation worker process talk to the same store,
+so any worker can serve any request (uploads, preview, SSE progress).
+"""
+
+import abc
+import json
+import os
+import sqlite3
+import threading
+import time
+
+SQLITE_TIMEOUT = 30
+# SQLite's default limit on bound parameters per statement is 999 on older builds
+_MAX_PARAMS = 500
+
+
+class Storage(abc.ABC):
+    """Interface for shared application state.
+
+    Images: uploaded PNGs and their parsed metadata.
+    Sessions: queued/running generation jobs with an append-only event log.
+    """
+
+    # --- Images ---
+
+    @abc.abstractmethod
+    def put_image(self, img_id: str, record: dict) -> None:
+        """Store an uploaded image record { filename, filepath, metadata, sha256 }."""
+
+    @abc.abstractmethod
+    def get_images(self, img_ids: list[str]) -> dict:
+        """Return { id: record } for the ids that exist."""
+
+    @abc.abstractmethod
+    def find_image_by_hash(self, sha256: str) -> tuple[str, dict] | None:
+        """Return (id, record) of an image with this content hash, or None."""
+
+    # --- Generation sessions ---
+
+    @abc.abstractmethod
+    def create_session(self, session_id: str, spec: dict) -> None:
+        """Queue a generation job. spec must be JSON-serializable."""
+
+    @abc.abstractmethod
+    def claim_session(self, worker_id: str) -> tuple[str, dict] | None:
+        """Atomically take the oldest queued job for worker_id and start its lease.
+
+        Returns (session_id, spec) or None.
+        """
+
+    @abc.abstractmethod
+    def heartbeat(self, session_id: str, worker_id: str) -> None:
+        """Renew the lease on a running job held by worker_id."""
+
+    @abc.abstractmethod
+    def session_exists(self, session_id: str) -> bool:
+        ...
+
+    @abc.abstractmethod
+    def add_event(self, session_id: str, event_type: str, data: dict) -> None:
+        ...
+
+    @abc.abstractmethod
+    def get_events(self, session_id: str, after: int = 0) -> list[tuple[int, str, dict]]:
+        """Return [(seq, event_type, data)] with seq > after, in order."""
+
+    @abc.abstractmethod
+    def finish_session(self, session_id: str) -> None:
+        ...
+
+    @abc.abstractmethod
+    def is_done(self, session_id: str) -> bool:
+        ...
+
+    @abc.abstractmethod
+    def delete_session(self, session_id: str) -> None:
+        ...
+
+    @abc.abstractmethod
+    def fail_interrupted_sessions(self, message: str, lease_seconds: float) -> None:
+        """Close running sessions whose lease has not been renewed for lease_seconds.
+
+        Sessions held by live workers keep renewing their lease and are left alone.
+        """
+
+
+class SQLiteStorage(Storage):
+    """Storage in a local SQLite file (WAL mode), safe across processes.
+
+    Each thread gets its own connection.
+    """
+
+    def __init__(self, path: str):
+        self.path = path
+        os.makedirs(os.path.dirname(os.path.abspath(path)), exist_ok=True)
+        self._local = threading.local()
+        with self._conn() as conn:
+            conn.executescript('''
+                CREATE TABLE IF NOT EXISTS images (
+                    id TEXT PRIMARY KEY,
+                    sha256 TEXT,
+                    record TEXT NOT NULL
+                );
+                CREATE INDEX IF NOT EXISTS images_sha256 ON images (sha256);
+                CREATE TABLE IF NOT EXISTS sessions (
+                    id TEXT PRIMARY KEY,
+                    status TEXT NOT NULL,  -- queued / running / done
+                    spec TEXT NOT NULL,
+                    created REAL NOT NULL,
+                    worker_id TEXT,  -- worker holding a running session
+                    heartbeat REAL   -- last lease renewal by that worker
+                );
+                CREATE INDEX IF NOT EXISTS sessions_status ON sessions (status, created);
+                CREATE TABLE IF NOT EXISTS events (
+                    seq INTEGER PRIMARY KEY AUTOINCREMENT,
+                    session_id TEXT NOT NULL,
+                    event TEXT NOT NULL,
+                    data TEXT NOT NULL
+                );
+                CREATE INDEX IF NOT EXISTS events_session ON events (session_id, seq);
+            ''')
+            # Databases created before session leases existed
+            columns = {row[1] for row in conn.execute('PRAGMA table_info(sessions)')}
+            for column, column_type in (('worker_id', 'TEXT'), ('heartbeat', 'REAL')):
+                if column not in columns:
+                    conn.execute(f'ALTER TABLE sessions ADD COLUMN {column} {column_type}')
+
+    def _conn(self) -> sqlite3.Connection:
+        conn = getattr(self._local, 'conn', None)
+        if conn is None:
+            conn = sqlite3.connect(self.path, timeout=SQLITE_TIMEOUT)
+            conn.execute('PRAGMA journal_mode=WAL')
+            conn.execute('PRAGMA synchronous=NORMAL')
+            self._local.conn = conn
+        return conn
+
+    # --- Images ---
+
+    def put_image(self, img_id, record):
+        with self._conn() as conn:
+            conn.execute(
+                'INSERT OR REPLACE INTO images (id, sha256, record) VALUES (?, ?, ?)',
+                (img_id, record.get('sha256'), json.dumps(record, ensure_ascii=False)),
+            )
+
+    def get_images(self, img_ids):
+        result = {}
+        conn = self._conn()
+        for i in range(0, len(img_ids), _MAX_PARAMS):
+            chunk = img_ids[i:i + _MAX_PARAMS]
+            rows = conn.execute(
+                f'SELECT id, record FROM images WHERE id IN ({",".join("?" * len(chunk))})',
+                chunk,
+            ).fetchall()
+            for img_id, record in rows:
+                result[img_id] = json.loads(record)
+        return result
+
+    def find_image_by_hash(self, sha256):
+        row = self._conn().execute(
+            'SELECT id, record FROM images WHERE sha256 = ? LIMIT 1', (sha256,),
+        ).fetchone()
+        return (row[0], json.loads(row[1])) if row else None
+
+    # --- Generation sessions ---
+
+    def create_session(self, session_id, spec):
+        with self._conn() as conn:
+            conn.execute(
+                'INSERT INTO sessions (id, status, spec, created) VALUES (?, ?, ?, ?)',
+                (session_id, 'queued', json.dumps(spec, ensure_ascii=False), time.time()),
+            )
+
+    def claim_session(self, worker_id):
+        conn = self._conn()
+        with conn:
+            # Take the write lock up front so two workers cannot claim the same job
+            conn.execute('BEGIN IMMEDIATE')
+            row = conn.execute(
+                "SELECT id, spec FROM sessions WHERE status = 'queued' ORDER BY created LIMIT 1",
+            ).fetchone()
+            if row is None:
+                return None
+            conn.execute(
+                "UPDATE sessions SET status = 'running', worker_id = ?, heartbeat = ? WHERE id = ?",
+                (worker_id, time.time(), row[0]),
+            )
+        return row[0], json.loads(row[1])
+
+    def heartbeat(self, session_id, worker_id):
+        with self._conn() as conn:
+            conn.execute(
+                "UPDATE sessions SET heartbeat = ? WHERE id = ? AND worker_id = ? AND status = 'running'",
+                (time.time(), session_id, worker_id),
+            )
+
+    def session_exists(self, session_id):
+        row = self._conn().execute('SELECT 1 FROM sessions WHERE id = ?', (session_id,)).fetchone()
+        return row is not None
+
+    def add_event(self, session_id, event_type, data):
+        with self._conn() as conn:
+            conn.execute(
+                'INSERT INTO events (session_id, event, data) VALUES (?, ?, ?)',
+                (session_id, event_type, json.dumps(data, ensure_ascii=False)),
+            )
+
+    def get_events(self, session_id, after=0):
+        rows = self._conn().execute(
+            'SELECT seq, event, data FROM events WHERE session_id = ? AND seq > ? ORDER BY seq',
+            (session_id, after),
+        ).fetchall()
+        return [(seq, event, json.loads(data)) for seq, event, data in rows]
+
+    def finish_session(self, session_id):
+        with self._conn() as conn:
+            conn.execute("UPDATE sessions SET status = 'done' WHERE id = ?", (session_id,))
+
+    def is_done(self, session_id):
+        row = self._conn().execute('SELECT status FROM sessions WHERE id = ?', (session_id,)).fetchone()
+        return row is None or row[0] == 'done'
+
+    def delete_session(self, session_id):
+        with self._conn() as conn:
+            conn.execute('DELETE FROM events WHERE session_id = ?', (session_id,))
+            conn.execute('DELETE FROM sessions WHERE id = ?', (session_id,))
+
+    def fail_interrupted_sessions(self, message, lease_seconds):
+        conn = self._conn()
+        with conn:
+            # One write transaction, so two workers cannot both fail a session
+            # and SSE readers see the closing events together with 'done'
+            conn.execute('BEGIN IMMEDIATE')
+            rows = conn.execute(
+                "SELECT id FROM sessions WHERE status = 'running' AND (heartbeat IS NULL OR heartbeat < ?)",
+                (time.time() - lease_seconds,),
+            ).fetchall()
+            for (session_id,) in rows:
+                for event_type, data in (
+                    ('error_event', {'filename': '', 'message': message}),
+                    ('complete', {
+                        'output_dir': '', 'output_subdir': '', 'total': 0, 'success': 0,
+                        'failed': 0, 'interrupted': True,
+                    }),
+                ):
+                    conn.execute(
+                        'INSERT INTO events (session_id, event, data) VALUES (?, ?, ?)',
+                        (session_id, event_type, json.dumps(data, ensure_ascii=False)),
+                    )
+                conn.execute("UPDATE sessions SET status = 'done' WHERE id = ?", (session_id,))
+
+
+def open_storage() -> Storage:
+    """Open the configured storage backend (STATE_DB, default .state/ next to the app).
+
+    The default is kept out of OUTPUT_DIR, whose contents are served over HTTP.
+    """
+    path = os.getenv('STATE_DB') or os.path.join(
+        os.path.dirname(os.path.abspath(__file__)), '.state', 'state.sqlite3',
+    )
+    return SQLiteStorage(path)
@@ -0,0 +1,269 @@
+"""Parameter sweep (X/Y grid) expansion and contact-sheet output."""
+
+import html
+import itertools
+import json
+import os
+import re
+from urllib.parse import quote
+
+from metadata_parser import apply_settings
+from prompt_editor import add_tags
+
+MAX_SWEEP_VARIANTS = 100000
+
+# Axes whose change forces Forge to load a different checkpoint/VAE.
+# These are kept outermost so each model is loaded once per sweep.
+CHECKPOINT_FIELDS = ('Model', 'VAE')
+SEED_FIELD = 'Seed'
+# Pseudo-fields: prepend an alternate tag set instead of changing a setting
+TAG_FIELDS = ('add_positive', 'add_negative')
+
+INDEX_FILE = 'index.jsonl'
+CONTACT_SHEET_FILE = 'index.html'
+# Thumbnail route relative to the served sheet (/api/output/<run>/index.html)
+PREVIEW_ROUTE = '../../output-preview'
+
+_re_unsafe = re.compile(r'[^\w.\-]+')
+
+
+def validate_sweep(spec: dict, image_count: int) -> list[dict]:
+    """Validate a sweep spec and return its axes.
+
+    spec: { axes: [{ field: 'CFG scale', values: [5, 7, 9] }, ...] }
+    Raises ValueError with a message for invalid specs.
+    """
+    axes = spec.get('axes') if isinstance(spec, dict) else None
+    if not isinstance(axes, list) or not axes:
+        raise ValueError('axes must be a non-empty list')
+
+    fields = set()
+    for i, axis in enumerate(axes):
+        if not isinstance(axis, dict):
+            raise ValueError(f'axis {i}: must be an object')
+        field = axis.get('field')
+        values = axis.get('values')
+        if not isinstance(field, str) or not field.strip():
+            raise ValueError(f'axis {i}: field is required')
+        if field in fields:
+            raise ValueError(f'axis {i}: duplicate field {field!r}')
+        if not isinstance(values, list) or not values:
+            raise ValueError(f'axis {i}: values must be a non-empty list')
+        if field == SEED_FIELD and not all(isinstance(v, int) and not isinstance(v, bool) for v in values):
+            raise ValueError(f'axis {i}: Seed values must be integers')
+        keys = [json.dumps(v, sort_keys=True) for v in values]
+        if len(set(keys)) != len(keys):
+            raise ValueError(f'axis {i}: duplicate values')
+        fields.add(field)
+
+    if count_variants(image_count, axes) > MAX_SWEEP_VARIANTS:
+        raise ValueError(f'too many variants (max {MAX_SWEEP_VARIANTS})')
+    return axes
+
+
+def count_variants(image_count: int, axes: list[dict]) -> int:
+    total = image_count
+    for axis in axes:
+        total *= len(axis['values'])
+    return total
+
+
+def order_axes(axes: list[dict]) -> tuple[list[dict], list[dict]]:
+    """Split axes into (checkpoint axes, inner axes).
+
+    Inner axes keep their given order except that Seed is moved last, so
+    variants differing only by seed are generated back to back.
+    """
+    checkpoint = [a for a in axes if a['field'] in CHECKPOINT_FIELDS]
+    inner = [a for a in axes if a['field'] not in CHECKPOINT_FIELDS and a['field'] != SEED_FIELD]
+    inner += [a for a in axes if a['field'] == SEED_FIELD]
+    return checkpoint, inner
+
+
+def iter_jobs(images: list[dict], axes: list[dict]):
+    """Lazily expand input images into sweep variants.
+
+    images must already be grouped by model and have their edits applied.
+    Yields dicts: { filename, input, stem, metadata, values, out_name } where
+    out_name is '<input stem>/<variant label>.png' relative to the output
+    directory (see _variant_label).
+    Only one variant's metadata exists at a time.
+    """
+    checkpoint_axes, inner_axes = order_axes(axes)
+    stems = _unique_stems(img['filename'] for img in images)
+
+    # Iterate (index, value) pairs so labels can use each value's axis index
+    for checkpoint_values in itertools.product(*(list(enumerate(a['values'])) for a in checkpoint_axes)):
+        for img_data, stem in zip(images, stems):
+            for inner_values in itertools.product(*(list(enumerate(a['values'])) for a in inner_axes)):
+                values = {}
+                indices = {}
+                for axis, (index, value) in zip(checkpoint_axes + inner_axes, checkpoint_values + inner_values):
+                    values[axis['field']] = value
+                    indices[axis['field']] = index
+                label = _variant_label(axes, values, indices)
+                yield {
+                    'filename': f"{img_data['filename']} [{label}]",
+                    'input': img_data['filename'],
+                    'stem': stem,
+                    'metadata': apply_variant(img_data['metadata'], values),
+                    'values': values,
+                    'out_name': f'{stem}/{label}.png',
+                }
+
+
+def apply_variant(metadata: dict, values: dict) -> dict:
+    """Return a copy of (edited) metadata with sweep values applied.
+
+    Setting values go through apply_settings so the metadata fields and
+    infotext agree. Tag-set axes are prepended to the edited prompts.
+    """
+    settings = {k: v for k, v in values.items() if k not in TAG_FIELDS}
+    if 'Model' in settings:
+        # The original hash would make Forge resolve the old checkpoint
+        settings.setdefault('Model hash', None)
+
+    result = apply_settings(metadata, settings)
+    if 'add_positive' in values:
+        result['positive_prompt'] = add_tags(result['positive_prompt'], str(values['add_positive']))
+    if 'add_negative' in values:
+        result['negative_prompt'] = add_tags(result['negative_prompt'], str(values['add_negative']))
+    return result
+
+
+def _variant_label(axes: list[dict], values: dict, indices: dict) -> str:
+    """Build a filesystem-safe label, in spec order.
+
+    Each part is '<field>-<index in axis>', plus a shortened value for
+    readability. The index alone keeps labels unique: sanitized or truncated
+    values can coincide (e.g. 'DPM++ 2M' and 'DPM 2M').
+    """
+    parts = []
+    for axis in axes:
+        field = axis['field']
+        part = f'{_safe_name(field)}-{indices[field]}'
+        if field not in TAG_FIELDS:
+            # Tag sets are long; the index is enough
+            part += f'_{_safe_name(str(values[field]))[:24]}'
+        parts.append(part)
+    return '__'.join(parts)
+
+
+def _safe_name(s: str) -> str:
+    return _re_unsafe.sub('_', s).strip('_') or '_'
+
+
+def _unique_stems(filenames) -> list[str]:
+    stems = []
+    seen = {}
+    for filename in filenames:
+        stem = _safe_name(os.path.splitext(filename)[0])
+        n = seen.get(stem, 0)
+        seen[stem] = n + 1
+        stems.append(stem if n == 0 else f'{stem}_{n}')
+    return stems
+
+
+def append_index(out_dir: str, entry: dict) -> None:
+    """Append one generated variant to the sweep index (JSON lines)."""
+    with open(os.path.join(out_dir, INDEX_FILE), 'a', encoding='utf-8') as f:
+        f.write(json.dumps(entry, ensure_ascii=False) + '\n')
+
+
+def write_contact_sheet(out_dir: str, axes: list[dict]) -> str | None:
+    """Render index.html from the sweep index, streaming it one table at a time.
+
+    The index is in generation order, so each input image's variants for one
+    Model/VAE combination are contiguous: that block becomes one table whose
+    columns are values of the innermost axis and whose rows are combinations
+    of the remaining inner axes. Model/VAE-only sweeps get one table per
+    combination with a row per input. Only the current row is held in memory.
+    Thumbnails come from the output preview route; links open the full PNG.
+    Returns the path, or None if nothing was generated.
+    """
+    index_path = os.path.join(out_dir, INDEX_FILE)
+    if not os.path.exists(index_path):
+        return None
+
+    checkpoint_axes, inner_axes = order_axes(axes)
+    checkpoint_fields = [a['field'] for a in checkpoint_axes]
+    if inner_axes:
+        col_field = inner_axes[-1]['field']
+        col_values = inner_axes[-1]['values']
+        row_fields = [a['field'] for a in inner_axes[:-1]]
+    else:
+        col_field = None
+        col_values = [None]
+        row_fields = []
+    row_header = ', '.join(row_fields) if inner_axes else 'input'
+    # Values round-trip through JSON: match them by their JSON form
+    col_index = {json.dumps(v, sort_keys=True): i for i, v in enumerate(col_values)}
+    preview_base = f'{PREVIEW_ROUTE}/{quote(os.path.basename(out_dir))}'
+    esc = html.escape
+
+    sheet_path = os.path.join(out_dir, CONTACT_SHEET_FILE)
+    with open(index_path, encoding='utf-8') as index, open(sheet_path, 'w', encoding='utf-8') as f:
+        f.write(
+            '<!DOCTYPE html><html><head><meta charset="UTF-8"><title>Sweep</title>\n'
+            '<style>body{font-family:sans-serif;background:#111;color:#ddd}'
+            'table{border-collapse:collapse;margin-bottom:24px}td,th{border:1px solid #333;padding:4px;'
+            'font-size:12px;vertical-align:top}img{max-width:256px;display:block}</style></head><body>\n'
+        )
+        block = row = None
+        cells = {}
+
+        def flush_row():
+            if row is None:
+                return
+            parts = [f'<tr><th>{esc(row[1])}</th>']
+            for col in range(len(col_values)):
+                entry = cells.get(col)
+                if entry:
+                    href = esc(quote(entry['file']))
+                    src = esc(f"{preview_base}/{quote(entry['file'])}")
+                    parts.append(f'<td><a href="{href}"><img src="{src}" loading="lazy"></a></td>')
+                else:
+                    parts.append('<td></td>')
+            parts.append('</tr>\n')
+            f.write(''.join(parts))
+
+        for line in index:
+            entry = json.loads(line)
+            values = entry['values']
+            checkpoint_label = _values_label(checkpoint_fields, values)
+            input_label = f"{entry['input']} ({entry['stem']})"
+            if inner_axes:
+                entry_block = (entry['stem'], checkpoint_label)
+                entry_row = (entry_block, _values_label(row_fields, values))
+                col = col_index.get(json.dumps(values.get(col_field), sort_keys=True), 0)
+            else:
+                entry_block = checkpoint_label
+                entry_row = (entry_block, input_label)
+                col = 0
+
+            if entry_row != row:
+                flush_row()
+                row, cells = entry_row, {}
+            if entry_block != block:
+                if block is not None:
+                    f.write('</table>\n')
+                block = entry_block
+                heading = input_label if inner_axes else checkpoint_label
+                if inner_axes and checkpoint_label:
+                    heading += f' / {checkpoint_label}'
+                header = ''.join(
+                    f'<th>{esc(col_field)}: {esc(str(v))}</th>' if col_field else '<th></th>'
+                    for v in col_values
+                )
+                f.write(f'<h2>{esc(heading)}</h2><table><tr><th>{esc(row_header)}</th>{header}</tr>\n')
+            cells[col] = entry
+
+        flush_row()
+        if block is not None:
+            f.write('</table>\n')
+        f.write('</body></html>\n')
+    return sheet_path
+
+
+def _values_label(fields: list[str], values: dict) -> str:
+    return ', '.join(f'{k}: {values.get(k)}' for k in fields)
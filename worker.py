@@ -0,0 +1,85 @@
+"""Generation worker process.
+
+Polls shared storage for queued generation jobs and runs them one at a time,
+writing progress events back to storage for the web tier to stream.
+
+Run alongside a multi-worker WSGI server:
+    python worker.py
+(`python app.py` starts one automatically.)
+
+Several workers may share one store. Each renews a lease (heartbeat) on the
+session it is running; a session whose lease expires is failed by whichever
+worker notices first, so a crashed worker's job is closed without touching
+jobs that live workers are still running.
+"""
+
+import os
+import socket
+import threading
+import time
+import traceback
+import uuid
+
+from dotenv import load_dotenv
+
+POLL_INTERVAL = 0.5
+HEARTBEAT_INTERVAL = 10
+# Must comfortably exceed HEARTBEAT_INTERVAL
+LEASE_SECONDS = 60
+
+
+def main():
+    load_dotenv()
+    # Imported after load_dotenv so storage picks up .env settings
+    from storage import open_storage
+    from generation import run_generation
+
+    storage = open_storage()
+    worker_id = f'{socket.gethostname()}:{os.getpid()}:{uuid.uuid4().hex[:8]}'
+    print(f"=== Generation worker started ({worker_id}) ===")
+
+    last_lease_check = time.monotonic() - HEARTBEAT_INTERVAL  # check on startup
+    while True:
+        if time.monotonic() - last_lease_check >= HEARTBEAT_INTERVAL:
+            storage.fail_interrupted_sessions('ワーカーが停止したため生成が中断されました', LEASE_SECONDS)
+            last_lease_check = time.monotonic()
+
+        claimed = storage.claim_session(worker_id)
+        if claimed is None:
+            time.sleep(POLL_INTERVAL)
+            continue
+
+        session_id, spec = claimed
+        stop_heartbeat = threading.Event()
+        heartbeat_thread = threading.Thread(
+            target=_heartbeat, args=(storage, session_id, worker_id, stop_heartbeat), daemon=True,
+        )
+        heartbeat_thread.start()
+        try:
+            run_generation(storage, session_id, spec)
+        except Exception as e:
+            # run_generation reports per-image errors itself; this is a crash
+            print(f"\n!!! Worker error for session {session_id} !!!")
+            print(traceback.format_exc())
+            storage.add_event(session_id, 'error_event', {'filename': '', 'message': str(e)})
+            storage.add_event(session_id, 'complete', {
+                'output_dir': '', 'output_subdir': '', 'total': 0, 'success': 0, 'failed': 0,
+            })
+            storage.finish_session(session_id)
+        finally:
+            stop_heartbeat.set()
+            heartbeat_thread.join()
+
+
+def _heartbeat(storage, session_id: str, worker_id: str, stop: threading.Event) -> None:
+    """Renew the session lease until stop is set."""
+    while not stop.wait(HEARTBEAT_INTERVAL):
+        try:
+            storage.heartbeat(session_id, worker_id)
+        except Exception:
+            # A missed renewal is retried next interval
+            print(traceback.format_exc())
+
+
+if __name__ == '__main__':
+    main()